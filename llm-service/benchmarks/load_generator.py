@@ -0,0 +1,138 @@
+"""llm-serviceの各エンドポイントに一定の同時実行数で負荷をかけ、スループットとレイテンシを測る。
+
+    python -m benchmarks.load_generator --base-url http://localhost:8000 --stub-url http://localhost:8001 \
+        --concurrency 1,4,8 --requests 40
+
+--stub-url を指定すると、スタブ側の処理時間を差し引いた「llm-serviceが上乗せしている時間」も表示する。
+アドミッション制御による429/503 (過負荷時の意図した拒否) はエラーとは別に rejected として数える。
+"""
+import argparse
+import asyncio
+import json
+import statistics
+import time
+import uuid
+
+import httpx
+
+FEEDBACK_TEXT = "今日はCTOの田中さんと話した。会社の技術スタックがモダンで面白そうだと感じた。ただ、給与面が少し気になる。ぜひ次の面接に進みたい。"
+
+def make_payload(route: str, unique: bool) -> dict:
+    # 補完キャッシュに当たらないよう、既定ではリクエストごとに本文を変える
+    text = f"{FEEDBACK_TEXT} ({uuid.uuid4().hex[:8]})" if unique else FEEDBACK_TEXT
+    if route == "/chat":
+        return {"messages": [{"sender": "user", "text": text}]}
+    return {"text": text}
+
+# アドミッション制御が過負荷時に返すステータス。障害ではなく負荷の上限に達したことを示す
+REJECTED_STATUSES = (429, 503)
+
+ROUTES = ["/chat", "/classify-feedback", "/chat/analyze", "/chat/deep_dive_questions", "/chat/rephrase"]
+
+def percentile(values: list[float], p: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(int(round(p / 100 * (len(ordered) - 1))), len(ordered) - 1)
+    return ordered[index]
+
+async def run_level(client: httpx.AsyncClient, route: str, concurrency: int, total: int, unique: bool) -> dict:
+    latencies: list[float] = []
+    errors = 0
+    rejected = 0
+    queue: asyncio.Queue[int] = asyncio.Queue()
+    for i in range(total):
+        queue.put_nowait(i)
+
+    async def worker():
+        nonlocal errors, rejected
+        while True:
+            try:
+                queue.get_nowait()
+            except asyncio.QueueEmpty:
+                return
+            started = time.perf_counter()
+            try:
+                response = await client.post(route, json=make_payload(route, unique))
+                if response.status_code in REJECTED_STATUSES:
+                    rejected += 1
+                    continue
+                response.raise_for_status()
+                latencies.append(time.perf_counter() - started)
+            except httpx.HTTPError:
+                errors += 1
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - started
+    return {
+        "route": route,
+        "concurrency": concurrency,
+        "requests": total,
+        "errors": errors,
+        "rejected": rejected,
+        "completed": len(latencies),
+        "throughput_rps": len(latencies) / elapsed if elapsed else 0.0,
+        "mean_ms": statistics.fmean(latencies) * 1000 if latencies else 0.0,
+        "p50_ms": percentile(latencies, 50) * 1000,
+        "p95_ms": percentile(latencies, 95) * 1000,
+        "p99_ms": percentile(latencies, 99) * 1000,
+    }
+
+async def stub_busy_ms_per_request(stub: httpx.AsyncClient, completed: int) -> float | None:
+    # スタブが実際に処理に使った時間 (1リクエストあたり)。rephraseのように1リクエストで複数回呼ぶ場合も含む
+    stats = (await stub.get("/stub/stats")).json()
+    return stats["busy_seconds"] * 1000 / completed if completed else None
+
+async def main_async(args):
+    routes = args.routes.split(",") if args.routes else ROUTES
+    levels = [int(c) for c in args.concurrency.split(",")]
+    results = []
+    timeout = httpx.Timeout(args.timeout)
+    limits = httpx.Limits(max_connections=max(levels) * 2)
+    async with httpx.AsyncClient(base_url=args.base_url, timeout=timeout, limits=limits) as client:
+        stub = httpx.AsyncClient(base_url=args.stub_url) if args.stub_url else None
+        try:
+            for route in routes:
+                for concurrency in levels:
+                    if stub:
+                        await stub.post("/stub/reset")
+                    result = await run_level(client, route, concurrency, args.requests, not args.repeat_text)
+                    if stub:
+                        busy_ms = await stub_busy_ms_per_request(stub, result["completed"])
+                        # 同時実行時はスタブのスロット待ちも上乗せ分に含まれる
+                        result["stub_ms"] = busy_ms
+                        result["overhead_ms"] = result["mean_ms"] - busy_ms if busy_ms is not None else None
+                    results.append(result)
+                    print_result(result)
+        finally:
+            if stub:
+                await stub.aclose()
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+
+def print_result(r: dict):
+    line = (
+        f"{r['route']:<28} c={r['concurrency']:<3} n={r['requests']:<4} err={r['errors']:<3} rej={r['rejected']:<3} "
+        f"rps={r['throughput_rps']:7.2f} p50={r['p50_ms']:8.1f}ms p95={r['p95_ms']:8.1f}ms p99={r['p99_ms']:8.1f}ms"
+    )
+    if r.get("overhead_ms") is not None:
+        line += f" stub={r['stub_ms']:8.1f}ms overhead={r['overhead_ms']:7.1f}ms"
+    print(line, flush=True)
+
+def main():
+    parser = argparse.ArgumentParser(description="Load generator for llm-service endpoints")
+    parser.add_argument("--base-url", default="http://localhost:8000", help="llm-service URL")
+    parser.add_argument("--stub-url", default="", help="stub llama-server URL (for overhead reporting)")
+    parser.add_argument("--routes", default="", help="comma separated routes (default: all)")
+    parser.add_argument("--concurrency", default="1,4,8", help="comma separated concurrency levels")
+    parser.add_argument("--requests", type=int, default=40, help="requests per route and level")
+    parser.add_argument("--timeout", type=float, default=120.0)
+    parser.add_argument("--repeat-text", action="store_true", help="send identical text (exercise the completion cache)")
+    parser.add_argument("--output", default="", help="write results as JSON")
+    asyncio.run(main_async(parser.parse_args()))
+
+if __name__ == "__main__":
+    main()
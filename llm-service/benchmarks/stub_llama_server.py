@@ -0,0 +1,161 @@
+"""llama-server (`/v1/completions`) のスタブ。実モデルなしでllm-serviceの性能を測るために使う。
+
+    python -m benchmarks.stub_llama_server --port 8001 --prompt-ms-per-token 0.5 --tokens-per-second 20
+
+llm-serviceは LLM_SERVER_URL=http://localhost:8001 で起動する。
+複数レプリカを試す場合はポートを変えて複数起動し、LLM_SERVER_URLS=http://localhost:8001,http://localhost:8002 とする。
+"""
+import argparse
+import asyncio
+import json
+import random
+import math
+import time
+import zlib
+
+import uvicorn
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.responses import StreamingResponse
+
+CLASSIFY_JSON = '{"impression": "面談は和やかだった。", "attraction": "技術スタックがモダン。", "concern": "給与面が気になる。", "aspiration": "高め", "next_step": "次に進めたい", "other": ""}'
+EMBEDDING_DIM = 256
+FILLER_TOKENS = ["具体的", "には", "、", "どの", "ような", "点", "が", "気", "に", "なり", "ました", "か", "？"]
+
+class StubConfig:
+    prompt_ms_per_token = 0.5 # プロンプト評価のトークンあたりの時間
+    tokens_per_second = 20.0 # 生成速度
+    completion_tokens = 64 # max_tokensより小さければこちらで打ち切る
+    slots = 4 # llama-serverの並列スロット数
+    error_rate = 0.0 # 500を返す確率
+    hang_rate = 0.0 # 応答せずに待ち続ける確率 (タイムアウトの再現)
+
+config = StubConfig()
+app = FastAPI()
+_slots: asyncio.Semaphore | None = None
+_stats = {"requests": 0, "errors": 0, "stopped_streams": 0, "busy_seconds": 0.0, "prompt_tokens": 0, "completion_tokens": 0}
+
+def count_tokens(text: str) -> int:
+    # 実トークナイザの代わりの概算 (日本語は1文字あたり約1.5トークン)
+    return len(text.encode("utf-8")) // 2 + 1
+
+def completion_tokens_for(body: dict) -> list[str]:
+    if "grammar" in body or "json_schema" in body or "JSON" in body["prompt"][-200:]:
+        return [CLASSIFY_JSON]
+    n = min(body.get("max_tokens") or config.completion_tokens, config.completion_tokens)
+    return [FILLER_TOKENS[i % len(FILLER_TOKENS)] for i in range(n)]
+
+def finish_reason_for(body: dict, tokens: list[str]) -> str:
+    return "length" if body.get("max_tokens") and len(tokens) >= body["max_tokens"] else "stop"
+
+async def maybe_inject_error():
+    if random.random() < config.error_rate:
+        _stats["errors"] += 1
+        raise HTTPException(status_code=500, detail="stub: injected error")
+    if random.random() < config.hang_rate:
+        await asyncio.sleep(3600)
+
+@app.post("/v1/completions")
+async def completions(request: Request):
+    global _slots
+    if _slots is None:
+        _slots = asyncio.Semaphore(config.slots)
+    body = await request.json()
+    _stats["requests"] += 1
+    await maybe_inject_error()
+
+    prompt_tokens = count_tokens(body["prompt"])
+    tokens = completion_tokens_for(body)
+    token_interval = 1.0 / config.tokens_per_second
+    usage = {"prompt_tokens": prompt_tokens, "completion_tokens": len(tokens), "total_tokens": prompt_tokens + len(tokens)}
+    _stats["prompt_tokens"] += prompt_tokens
+    _stats["completion_tokens"] += len(tokens)
+
+    if body.get("stream"):
+        async def events():
+            async with _slots:
+                started = time.perf_counter()
+                try:
+                    await asyncio.sleep(prompt_tokens * config.prompt_ms_per_token / 1000)
+                    for i, token in enumerate(tokens):
+                        await asyncio.sleep(token_interval)
+                        # llama_cpp.serverと同じく、最後のチャンクにfinish_reasonを付ける
+                        finish_reason = finish_reason_for(body, tokens) if i == len(tokens) - 1 else None
+                        yield f"data: {json.dumps({'choices': [{'text': token, 'index': 0, 'finish_reason': finish_reason}]}, ensure_ascii=False)}\n\n"
+                    yield "data: [DONE]\n\n"
+                except (asyncio.CancelledError, GeneratorExit):
+                    # クライアントが切断した: 生成を止めてスロットを空ける
+                    _stats["stopped_streams"] += 1
+                    raise
+                finally:
+                    _stats["busy_seconds"] += time.perf_counter() - started
+        return StreamingResponse(events(), media_type="text/event-stream")
+
+    async with _slots:
+        started = time.perf_counter()
+        await asyncio.sleep(prompt_tokens * config.prompt_ms_per_token / 1000 + len(tokens) * token_interval)
+        _stats["busy_seconds"] += time.perf_counter() - started
+    return {"choices": [{"text": "".join(tokens), "index": 0, "finish_reason": finish_reason_for(body, tokens)}], "usage": usage}
+
+@app.post("/tokenize")
+async def tokenize(request: Request):
+    body = await request.json()
+    return {"tokens": list(range(count_tokens(body.get("content", ""))))}
+
+@app.post("/extras/tokenize/count")
+async def tokenize_count(request: Request):
+    # llama_cpp.server の形式
+    body = await request.json()
+    return {"count": count_tokens(body.get("input", ""))}
+
+@app.post("/v1/embeddings")
+async def embeddings(request: Request):
+    # 文字バイグラムのハッシュで作る疑似埋め込み。言い回しが近いほどコサイン類似度が高くなる
+    body = await request.json()
+    text = body.get("input", "")
+    vector = [0.0] * EMBEDDING_DIM
+    for i in range(max(len(text) - 1, 1)):
+        vector[zlib.crc32(text[i:i + 2].encode("utf-8")) % EMBEDDING_DIM] += 1.0
+    norm = math.sqrt(sum(v * v for v in vector)) or 1.0
+    return {"object": "list", "data": [{"object": "embedding", "index": 0, "embedding": [v / norm for v in vector]}]}
+
+@app.get("/health")
+async def health():
+    return {"status": "ok"}
+
+# llm-serviceのヘルスチェック (LLM_HEALTH_CHECK_PATH) の既定の宛先 /openapi.json はFastAPIが自動で返す
+@app.get("/v1/models")
+async def models():
+    return {"object": "list", "data": [{"id": "stub", "object": "model"}]}
+
+@app.get("/stub/stats")
+async def stats():
+    return _stats
+
+@app.post("/stub/reset")
+async def reset():
+    for key in _stats:
+        _stats[key] = 0 if key != "busy_seconds" else 0.0
+    return _stats
+
+def main():
+    parser = argparse.ArgumentParser(description="Stub llama-server for llm-service benchmarks")
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=8001)
+    parser.add_argument("--prompt-ms-per-token", type=float, default=config.prompt_ms_per_token)
+    parser.add_argument("--tokens-per-second", type=float, default=config.tokens_per_second)
+    parser.add_argument("--completion-tokens", type=int, default=config.completion_tokens)
+    parser.add_argument("--slots", type=int, default=config.slots)
+    parser.add_argument("--error-rate", type=float, default=config.error_rate)
+    parser.add_argument("--hang-rate", type=float, default=config.hang_rate)
+    args = parser.parse_args()
+
+    config.prompt_ms_per_token = args.prompt_ms_per_token
+    config.tokens_per_second = args.tokens_per_second
+    config.completion_tokens = args.completion_tokens
+    config.slots = args.slots
+    config.error_rate = args.error_rate
+    config.hang_rate = args.hang_rate
+    uvicorn.run(app, host=args.host, port=args.port, log_level="warning")
+
+if __name__ == "__main__":
+    main()
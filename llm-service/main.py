@@ -1,10 +1,23 @@
+import time
+_import_started = time.perf_counter() # 起動時間の計測用 (以降のimportも含める)
+
 from fastapi import FastAPI
 from routers import feedback_router
 from routers import chat_router
 from routers import analyze_router
 from routers import rephrase_router
 from routers import deep_dive_router
-from services.llm_service import load_llm_model
+from routers import metrics_router
+from routers import jobs_router
+from routers import insight_router
+from routers import health_router
+from services.llm_service import load_llm_model, close_llm_client
+from services.completion_cache import completion_cache
+from services.job_queue import job_queue
+from services.semantic_cache import semantic_cache
+from services.startup import startup
+from services.metrics import MetricsMiddleware
+from services.telemetry import create_sampler, setup_logging
 import logging
 from opentelemetry import trace
 from opentelemetry.sdk.resources import Resource
@@ -19,7 +32,7 @@ from opentelemetry.exporter.otlp.proto.grpc._log_exporter import OTLPLogExporter
 
 # OpenTelemetry Tracingの設定
 resource = Resource.create({"service.name": "llm-service"})
-provider = TracerProvider(resource=resource)
+provider = TracerProvider(resource=resource, sampler=create_sampler()) # ルートごとの比率でサンプリング
 processor = BatchSpanProcessor(OTLPSpanExporter(endpoint="http://otel-collector:4317")) # OTLP CollectorのgRPCエンドポイント
 provider.add_span_processor(processor)
 trace.set_tracer_provider(provider)
@@ -29,7 +42,8 @@ log_provider = LoggerProvider(resource=resource)
 log_exporter = OTLPLogExporter(endpoint="http://otel-collector:4317", insecure=True)
 log_provider.add_log_record_processor(BatchLogRecordProcessor(log_exporter))
 handler = LoggingHandler(level=logging.INFO, logger_provider=log_provider)
-logging.getLogger().addHandler(handler)
+# stdoutへの出力は別スレッドで行う。OTLPはスパンの情報を付けるためログを出したスレッドで記録し、送信はバッチで行う
+log_listener = setup_logging(handler)
 
 app = FastAPI()
 
@@ -41,9 +55,36 @@ HTTPXClientInstrumentor().instrument()
 @app.on_event("startup")
 async def startup_event():
     await load_llm_model()
+    # 前回実行中だったジョブを待ち行列に戻してからワーカーを起動する
+    await job_queue.start()
+    # llama-serverの応答待ちとプロンプトキャッシュの温めはバックグラウンドで行い、終わるまで GET /ready は503を返す
+    startup.start()
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    await startup.stop()
+    await job_queue.stop()
+    # 共有HTTPクライアントのコネクションプールを解放
+    await close_llm_client()
+    completion_cache.close()
+    semantic_cache.close()
+    log_listener.stop()
 
 app.include_router(feedback_router.router)
 app.include_router(chat_router.router)
 app.include_router(analyze_router.router)
 app.include_router(rephrase_router.router)
-app.include_router(deep_dive_router.router)
\ No newline at end of file
+app.include_router(deep_dive_router.router)
+app.include_router(metrics_router.router)
+app.include_router(jobs_router.router)
+app.include_router(insight_router.router)
+app.include_router(health_router.router)
+
+# ルートごとのメトリクス (ラベルはルートのパステンプレート)
+app.add_middleware(MetricsMiddleware, route_paths=[
+    route.path
+    for module in (feedback_router, chat_router, analyze_router, rephrase_router, deep_dive_router, jobs_router, insight_router)
+    for route in module.router.routes
+])
+
+startup.record_import(_import_started)
@@ -35,4 +35,18 @@ JSON出力:
 
 JSON出力:
 ```json
-"""
\ No newline at end of file
+"""
+
+# 文法(GBNF)/JSONスキーマで出力形式を強制する場合のプロンプト。
+# 形式の説明は文法側が担うため、例は1行のみにしてプロンプト評価を軽くする
+CLASSIFY_FEEDBACK_STRUCTURED_PROMPT = """[指示]
+フィードバックテキストを以下のカテゴリに分類し、JSONで出力してください。該当しないカテゴリは空文字列にしてください。
+impression: 全体的な感想 / attraction: 魅力点 / concern: 懸念点 / aspiration: 志望度 / next_step: 次のステップ / other: その他
+
+[例]
+テキスト: 会社の技術スタックがモダンで面白そう。ただ給与面が少し気になる。ぜひ次に進みたい。
+JSON: {{"impression": "", "attraction": "技術スタックがモダンで面白そう。", "concern": "給与面が少し気になる。", "aspiration": "高め", "next_step": "次に進めたい", "other": ""}}
+
+[本番]
+テキスト: {user_text}
+JSON: """
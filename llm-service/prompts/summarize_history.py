@@ -0,0 +1,17 @@
+SUMMARIZE_HISTORY_PROMPT = """[指示]
+以下はユーザーとアシスタントの「壁打ち」対話の古い部分です。
+後続の対話で参照できるよう、ユーザーが話した事実・考え・感情の要点を日本語で簡潔に要約してください。
+
+[ルール]
+- 要約は3〜5文以内にしてください。
+- あなた自身の意見や感想は含めないでください。
+- 既存の要約がある場合は、その内容も引き継いでください。
+
+[既存の要約]
+{previous_summary}
+
+[対話]
+{conversation}
+
+[要約]
+"""
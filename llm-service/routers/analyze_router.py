@@ -1,29 +1,70 @@
-from fastapi import APIRouter, HTTPException
+import os
+import logging
+from fastapi import APIRouter, HTTPException, Request
 from pydantic import BaseModel
-from services.llm_service import call_llm
+from services.llm_service import call_llm, stream_llm
+from services.sse import iter_text, sse_response
+from services.admission import AdmissionRejected
+from services.request_scope import RequestCancelled, request_scope
+from services.semantic_cache import semantic_cache
+from services.context_manager import fit_text
+from services.startup import startup
 from prompts.analyze_chat import ANALYZE_CHAT_PROMPT
 
+logger = logging.getLogger(__name__)
+
 router = APIRouter()
 
+ANALYZE_DEADLINE = float(os.getenv("ANALYZE_DEADLINE", "60")) # 秒。この時間を過ぎたら上流の生成を中断する (0以下で無期限)
+
+startup.register_prompt("analyze", ANALYZE_CHAT_PROMPT)
+
 class AnalyzeRequest(BaseModel):
     text: str
+    stream: bool = False # TrueでServer-Sent Eventsとしてトークンを逐次返す
+
+async def build_prompt(user_text: str) -> str:
+    # 長いフィードバックは生成分(max_tokens)を残してN_CTXに収まるよう切り詰める
+    user_text = await fit_text(ANALYZE_CHAT_PROMPT, user_text, max_tokens=300)
+    return ANALYZE_CHAT_PROMPT.format(user_text=user_text)
+
+async def analyze_text(user_text: str) -> str:
+    cached, semantic_query = await semantic_cache.lookup("/chat/analyze", user_text)
+    if cached is not None:
+        return cached
+
+    llm_reply = await call_llm(
+        await build_prompt(user_text),
+        max_tokens=300,
+        stop=["\n\n"],
+        temperature=0.7,
+    )
+    logger.debug("LLM Analyze Reply: %s", llm_reply)
+    await semantic_cache.store(semantic_query, llm_reply)
+    return llm_reply
 
 @router.post("/chat/analyze")
-async def analyze_chat(request: AnalyzeRequest):
+async def analyze_chat(request: AnalyzeRequest, http_request: Request):
     user_text = request.text
 
-    prompt = ANALYZE_CHAT_PROMPT.format(user_text=user_text)
-
     try:
-        llm_reply = await call_llm(
-            prompt,
-            max_tokens=300,
-            stop=["\n\n"],
-            temperature=0.7,
-        )
-        print(f"LLM Analyze Reply: {llm_reply}")
-        return {"reply": llm_reply}
+        with request_scope(http_request, ANALYZE_DEADLINE):
+            if not request.stream:
+                return {"reply": await analyze_text(user_text)}
+
+            # 言い回しだけが違う既出のフィードバックには、埋め込みの類似度で過去の応答を返す
+            cached, semantic_query = await semantic_cache.lookup("/chat/analyze", user_text)
+            if cached is not None:
+                return await sse_response(iter_text(cached))
+            return await sse_response(semantic_cache.store_stream(semantic_query, stream_llm(
+                await build_prompt(user_text),
+                max_tokens=300,
+                stop=["\n\n"],
+                temperature=0.7,
+            )))
 
+    except (AdmissionRejected, RequestCancelled, HTTPException):
+        raise
     except Exception as e:
-        print(f"Error during LLM analysis: {e}")
+        logger.exception("Error during LLM analysis: %s", e)
         raise HTTPException(status_code=500, detail=f"LLM分析中にエラーが発生しました: {e}")
\ No newline at end of file
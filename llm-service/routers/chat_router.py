@@ -1,40 +1,148 @@
-from fastapi import APIRouter, HTTPException
+import os
+import logging
+from fastapi import APIRouter, HTTPException, Request
 from pydantic import BaseModel
-from services.llm_service import call_llm
+from services.llm_service import call_llm, stream_llm
+from services.sse import sse_response
+from services.admission import AdmissionRejected
+from services.request_scope import RequestCancelled, request_scope
+from services.chat_session import chat_sessions, ChatSession
+from services.context_manager import fit_history
+from services.startup import startup
 from prompts.chat import CHAT_SYSTEM_PROMPT
 
+logger = logging.getLogger(__name__)
+
 router = APIRouter()
 
+CHAT_MAX_TOKENS = 500
+CHAT_STOP = ["ユーザー:", "アシスタント:", "\n\n"]
+CHAT_DEADLINE = float(os.getenv("CHAT_DEADLINE", "60")) # 秒。クライアントが待つのをやめた生成はこの時点で中断する (0以下で無期限)
+
+startup.register_prompt("chat", CHAT_SYSTEM_PROMPT)
+
 class ChatMessage(BaseModel):
     sender: str
     text: str
 
 class ChatRequest(BaseModel):
     messages: list[ChatMessage]
+    stream: bool = False # TrueでServer-Sent Eventsとしてトークンを逐次返す
+    # 指定するとサーバー側セッションモードになり、messagesには新しいメッセージだけを送ればよい
+    session_id: str | None = None
 
-@router.post("/chat")
-async def chat(request: ChatRequest):
-    system_prompt = CHAT_SYSTEM_PROMPT
-    
-    conversation_history = ""
-    for msg in request.messages:
+def format_messages(messages: list[ChatMessage]) -> list[str]:
+    conversation_history = []
+    for msg in messages:
         if msg.sender == 'user':
-            conversation_history += f"ユーザー: {msg.text}\n"
+            conversation_history.append(f"ユーザー: {msg.text}\n")
         else:
-            conversation_history += f"アシスタント: {msg.text}\n"
+            conversation_history.append(f"アシスタント: {msg.text}\n")
+    return conversation_history
 
-    prompt = f"{system_prompt}{conversation_history}アシスタント:"
+@router.post("/chat")
+async def chat(request: ChatRequest, http_request: Request):
+    with request_scope(http_request, CHAT_DEADLINE):
+        if request.session_id:
+            return await chat_with_session(request)
+        return await chat_stateless(request)
+
+async def chat_stateless(request: ChatRequest):
+    system_prompt = CHAT_SYSTEM_PROMPT
+    
+    conversation_history = format_messages(request.messages)
 
     try:
+        # 生成分(max_tokens)を含めてN_CTXに収まるよう、古いターンを切り捨てる。
+        # 要約を持ち越す先が無く、省くターンが毎回変わって要約を作り直すことになるため、要約はセッションモードだけで行う
+        prompt, _, _ = await fit_history(system_prompt, conversation_history, "アシスタント:", CHAT_MAX_TOKENS, strategy="trim")
+
+        if request.stream:
+            return await sse_response(stream_llm(
+                prompt,
+                max_tokens=CHAT_MAX_TOKENS,
+                stop=CHAT_STOP,
+                temperature=0.7,
+            ))
+
         llm_reply = await call_llm(
             prompt,
-            max_tokens=500,
-            stop=["ユーザー:", "アシスタント:", "\n\n"],
+            max_tokens=CHAT_MAX_TOKENS,
+            stop=CHAT_STOP,
             temperature=0.7,
         )
-        print(f"LLM Reply: {llm_reply}")
+        logger.debug("LLM Reply: %s", llm_reply)
         return {"reply": llm_reply}
 
+    except (AdmissionRejected, RequestCancelled, HTTPException):
+        # 混雑による拒否・期限切れ・切断・バックエンド無し (503) はそのステータスのままクライアントに返す
+        raise
     except Exception as e:
-        print(f"Error during LLM chat: {e}")
-        raise HTTPException(status_code=500, detail=f"LLMチャット中にエラーが発生しました: {e}")
\ No newline at end of file
+        logger.exception("Error during LLM chat: %s", e)
+        raise HTTPException(status_code=500, detail=f"LLMチャット中にエラーが発生しました: {e}")
+
+async def chat_with_session(request: ChatRequest):
+    # 構築済みの履歴に新しいメッセージだけを追記し、llama-serverには同じスロットで共通接頭辞を再利用させる
+    session, created = chat_sessions.get_or_create(request.session_id, CHAT_SYSTEM_PROMPT)
+    new_messages = format_messages(request.messages)
+
+    try:
+        if request.stream:
+            return await sse_response(_stream_session_turn(session, new_messages))
+
+        async with session.lock:
+            turns, prompt, dropped, summary = await _build_session_prompt(session, new_messages)
+            llm_reply = await call_llm(
+                prompt,
+                max_tokens=CHAT_MAX_TOKENS,
+                stop=CHAT_STOP,
+                temperature=0.7,
+                extra_params=session.llm_params(),
+                affinity=session.session_id, # レプリカが複数でも同じセッションは同じサーバーのKVキャッシュを使う
+            )
+            _commit_turn(session, turns[dropped:], summary, llm_reply)
+        logger.debug("LLM Reply (session=%s, turn=%d): %s", session.session_id, session.turns, llm_reply)
+        return {"reply": llm_reply, "session_id": session.session_id, "new_session": created}
+
+    except (AdmissionRejected, RequestCancelled, HTTPException):
+        raise
+    except Exception as e:
+        logger.exception("Error during LLM chat: %s", e)
+        raise HTTPException(status_code=500, detail=f"LLMチャット中にエラーが発生しました: {e}")
+
+async def _stream_session_turn(session: ChatSession, new_messages: list[str]):
+    async with session.lock:
+        turns, prompt, dropped, summary = await _build_session_prompt(session, new_messages)
+        chunks = []
+        async for token in stream_llm(
+            prompt,
+            max_tokens=CHAT_MAX_TOKENS,
+            stop=CHAT_STOP,
+            temperature=0.7,
+            extra_params=session.llm_params(),
+            affinity=session.session_id,
+        ):
+            chunks.append(token)
+            yield token
+        # 最後まで生成できたターンだけをセッションに反映する
+        _commit_turn(session, turns[dropped:], summary, "".join(chunks).strip())
+
+async def _build_session_prompt(session: ChatSession, new_messages: list[str]):
+    # 予算内なら既存のプロンプトの末尾に追記するだけなので、llama-server側の共通接頭辞はそのまま再利用される。
+    # あふれた場合だけ古いターンを要約に圧縮してプロンプトを組み直す
+    turns = session.history + new_messages
+    prompt, dropped, summary = await fit_history(
+        session.system_prompt, turns, "アシスタント:", CHAT_MAX_TOKENS, session.summary
+    )
+    return turns, prompt, dropped, summary
+
+def _commit_turn(session: ChatSession, turns: list[str], summary: str, llm_reply: str):
+    session.history = turns + [f"アシスタント: {llm_reply}\n"]
+    session.summary = summary
+    session.turns += 1
+
+@router.delete("/chat/sessions/{session_id}")
+async def delete_chat_session(session_id: str):
+    if not chat_sessions.delete(session_id):
+        raise HTTPException(status_code=404, detail="Chat session not found.")
+    return {"deleted": session_id}
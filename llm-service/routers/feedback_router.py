@@ -1,12 +1,31 @@
-from fastapi import APIRouter, HTTPException
-from pydantic import BaseModel
+from fastapi import APIRouter, HTTPException, Request
+from fastapi.responses import StreamingResponse
+from pydantic import BaseModel, ValidationError
 from services.llm_service import call_llm
-from prompts.classify_feedback import CLASSIFY_FEEDBACK_PROMPT
+from services.backend_pool import LLM_PARALLEL_SLOTS
+from services.structured_output import json_object_grammar, json_schema
+from services.metrics import record_error
+from services.admission import AdmissionRejected
+from services.request_scope import RequestCancelled, request_scope
+from services.semantic_cache import semantic_cache
+from services.telemetry import set_text_attribute
+from services.startup import startup
+from prompts.classify_feedback import CLASSIFY_FEEDBACK_PROMPT, CLASSIFY_FEEDBACK_STRUCTURED_PROMPT
+from typing import AsyncIterator
+import asyncio
+import logging
 import json
+import os
 from opentelemetry import trace
 
+logger = logging.getLogger(__name__)
+
 router = APIRouter()
 
+# 出力形式の強制方法: "grammar" (GBNF), "json_schema", "off" (従来のプロンプトのみ)
+CLASSIFY_STRUCTURED_OUTPUT = os.getenv("CLASSIFY_STRUCTURED_OUTPUT", "grammar")
+CLASSIFY_DEADLINE = float(os.getenv("CLASSIFY_DEADLINE", "60")) # 秒 (0以下で無期限)
+
 class TextClassificationRequest(BaseModel):
     text: str
 
@@ -18,50 +37,160 @@ class FeedbackClassificationResponse(BaseModel):
     next_step: str = ""
     other: str = ""
 
+class BatchClassificationRequest(BaseModel):
+    texts: list[str]
+
+class BatchClassificationItem(BaseModel):
+    index: int
+    result: FeedbackClassificationResponse | None = None
+    error: str | None = None
+
+if CLASSIFY_STRUCTURED_OUTPUT == "grammar":
+    CLASSIFY_LLM_PARAMS = {"grammar": json_object_grammar(FeedbackClassificationResponse)}
+elif CLASSIFY_STRUCTURED_OUTPUT == "json_schema":
+    CLASSIFY_LLM_PARAMS = {"json_schema": json_schema(FeedbackClassificationResponse)}
+else:
+    CLASSIFY_LLM_PARAMS = None
+startup.register_prompt("classify_feedback", CLASSIFY_FEEDBACK_STRUCTURED_PROMPT if CLASSIFY_LLM_PARAMS else CLASSIFY_FEEDBACK_PROMPT)
+
+async def classify_text(user_text: str) -> FeedbackClassificationResponse:
+    # 言い回しだけが違う既出のフィードバックは、埋め込みの類似度で過去の分類結果を再利用する
+    cached, semantic_query = await semantic_cache.lookup("/classify-feedback", user_text)
+    if cached is not None:
+        return FeedbackClassificationResponse.model_validate_json(cached)
+
+    if CLASSIFY_LLM_PARAMS:
+        # 出力は文法で妥当なJSONに制約され、閉じ括弧の直後で生成が止まる
+        prompt = CLASSIFY_FEEDBACK_STRUCTURED_PROMPT.format(user_text=user_text)
+    else:
+        prompt = CLASSIFY_FEEDBACK_PROMPT.format(user_text=user_text)
+
+    generated_text = await call_llm(
+        prompt,
+        max_tokens=500,
+        stop=["```"],
+        temperature=0.1,
+        extra_params=CLASSIFY_LLM_PARAMS,
+    )
+
+    try:
+        json_start = generated_text.find('{')
+        json_end = generated_text.rfind('}') + 1
+        if json_start != -1 and json_end != -1:
+            json_string = generated_text[json_start:json_end]
+            classification_result = json.loads(json_string)
+        else:
+            raise ValueError("LLM output is not a valid JSON string.")
+    except json.JSONDecodeError as e:
+        record_error("JSONDecodeError")
+        logger.error("JSON Decode Error: %s, generated text: %s", e, generated_text)
+        raise HTTPException(status_code=500, detail="Failed to parse LLM output as JSON.")
+    except ValueError as e:
+        record_error("JSONNotFound")
+        logger.error("Value Error: %s, generated text: %s", e, generated_text)
+        raise HTTPException(status_code=500, detail="LLM output does not contain valid JSON.")
+
+    response_data = FeedbackClassificationResponse(**classification_result)
+    await semantic_cache.store(semantic_query, response_data.model_dump_json())
+    return response_data
+
 @router.post("/classify-feedback")
-async def classify_feedback(request: TextClassificationRequest):
+async def classify_feedback(request: TextClassificationRequest, http_request: Request):
     user_text = request.text
 
     # 現在のスパンを取得し、エンドポイントの入力を記録
     span = trace.get_current_span()
-    span.set_attribute("input.value", user_text)
-
-    prompt = CLASSIFY_FEEDBACK_PROMPT.format(user_text=user_text)
+    set_text_attribute(span, "input.value", user_text)
 
     try:
-        generated_text = await call_llm(
-            prompt,
-            max_tokens=500,
-            stop=["```"],
-            temperature=0.1,
-        )
-        
-        try:
-            json_start = generated_text.find('{')
-            json_end = generated_text.rfind('}') + 1
-            if json_start != -1 and json_end != -1:
-                json_string = generated_text[json_start:json_end]
-                classification_result = json.loads(json_string)
-            else:
-                raise ValueError("LLM output is not a valid JSON string.")
-        except json.JSONDecodeError as e:
-            print(f"JSON Decode Error: {e}")
-            print(f"Generated text: {generated_text}")
-            raise HTTPException(status_code=500, detail="Failed to parse LLM output as JSON.")
-        except ValueError as e:
-            print(f"Value Error: {e}")
-            print(f"Generated text: {generated_text}")
-            raise HTTPException(status_code=500, detail="LLM output does not contain valid JSON.")
-
-        response_data = FeedbackClassificationResponse(**classification_result)
+        with request_scope(http_request, CLASSIFY_DEADLINE):
+            response_data = await classify_text(user_text)
 
         # エンドポイントの最終的な出力を記録
-        span.set_attribute("output.value", response_data.model_dump_json())
+        if span.is_recording():
+            set_text_attribute(span, "output.value", response_data.model_dump_json())
 
         return response_data
 
+    except (AdmissionRejected, RequestCancelled, HTTPException):
+        raise
     except Exception as e:
-        print(f"Error during LLM classification: {e}")
+        logger.exception("Error during LLM classification: %s", e)
         span.set_attribute("error", True)
-        span.set_attribute("error.message", str(e))
-        raise HTTPException(status_code=500, detail=f"LLM分類中にエラーが発生しました: {e}")
\ No newline at end of file
+        set_text_attribute(span, "error.message", str(e))
+        raise HTTPException(status_code=500, detail=f"LLM分類中にエラーが発生しました: {e}")
+
+async def _iter_batch_texts(request: Request) -> AsyncIterator[str | Exception]:
+    """JSON (`{"texts": [...]}`) またはNDJSON (1行1件) の入力からテキストを順に取り出す。"""
+    content_type = request.headers.get("content-type", "")
+    if "ndjson" not in content_type:
+        try:
+            batch = BatchClassificationRequest.model_validate_json(await request.body())
+        except ValidationError as e:
+            raise HTTPException(status_code=422, detail=e.errors(include_url=False, include_input=False))
+        for text in batch.texts:
+            yield text
+        return
+
+    buffer = b""
+    async for chunk in request.stream():
+        buffer += chunk
+        *lines, buffer = buffer.split(b"\n")
+        for line in lines:
+            if line.strip():
+                yield _parse_ndjson_line(line)
+    if buffer.strip():
+        yield _parse_ndjson_line(buffer)
+
+def _parse_ndjson_line(line: bytes) -> str | Exception:
+    # 1行は {"text": "..."} または JSON文字列。不正な行はその行だけエラーとして返す
+    try:
+        item = json.loads(line)
+        if isinstance(item, dict):
+            item = item.get("text")
+        if not isinstance(item, str):
+            raise ValueError("each line must be a JSON string or an object with a \"text\" field")
+        return item
+    except ValueError as e:
+        return e
+
+@router.post("/classify-feedback/batch")
+async def classify_feedback_batch(request: Request):
+    semaphore = asyncio.Semaphore(LLM_PARALLEL_SLOTS)
+
+    async def classify_item(item: str | Exception) -> FeedbackClassificationResponse:
+        if isinstance(item, Exception):
+            raise item
+        async with semaphore:
+            return await classify_text(item)
+
+    # 入力を読みながら分類を開始する (同時実行数はセマフォでllama-serverのスロット数に制限)。
+    # StreamingResponseの開始後はリクエストボディを読めないため、入力はここで読み切る
+    tasks: list[asyncio.Task] = []
+    try:
+        async for item in _iter_batch_texts(request):
+            tasks.append(asyncio.create_task(classify_item(item)))
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        raise
+
+    async def to_line(index: int, task: asyncio.Task) -> str:
+        try:
+            result = BatchClassificationItem(index=index, result=await task)
+        except Exception as e:
+            logger.error("Error during LLM batch classification (index=%d): %s", index, e)
+            detail = e.detail if isinstance(e, HTTPException) else str(e)
+            result = BatchClassificationItem(index=index, error=str(detail))
+        return result.model_dump_json(exclude_none=True) + "\n"
+
+    async def results():
+        # 入力順を保ったまま、先頭から完了したものを順に返す
+        try:
+            for index, task in enumerate(tasks):
+                yield await to_line(index, task)
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    return StreamingResponse(results(), media_type="application/x-ndjson")
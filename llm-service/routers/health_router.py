@@ -0,0 +1,15 @@
+from fastapi import APIRouter
+from fastapi.responses import JSONResponse
+from services.startup import startup
+
+router = APIRouter()
+
+@router.get("/health")
+async def health():
+    # liveness: プロセスが応答できればよい
+    return {"status": "ok"}
+
+@router.get("/ready")
+async def ready():
+    # readiness: llama-serverが応答し、プロンプトキャッシュの温めが終わるまで503を返す
+    return JSONResponse(startup.status(), status_code=200 if startup.ready else 503)
@@ -0,0 +1,107 @@
+import os
+import asyncio
+import logging
+from fastapi import APIRouter, HTTPException, Request
+from fastapi.responses import StreamingResponse
+from pydantic import BaseModel
+from services.sse import format_sse
+from services.admission import AdmissionRejected
+from services.request_scope import RequestCancelled, request_scope
+from services.semantic_cache import semantic_cache
+from services.context_manager import count_tokens
+from routers.feedback_router import FeedbackClassificationResponse, classify_text
+from routers.analyze_router import analyze_text
+from routers.deep_dive_router import deep_dive_text
+
+logger = logging.getLogger(__name__)
+
+router = APIRouter()
+
+INSIGHTS_DEADLINE = float(os.getenv("INSIGHTS_DEADLINE", "60")) # 秒 (0以下で無期限)
+
+class InsightRequest(BaseModel):
+    text: str
+    stream: bool = False # Trueで各結果を完了した順にServer-Sent Eventsで返す
+
+class InsightResponse(BaseModel):
+    classification: FeedbackClassificationResponse | None = None
+    analysis: str | None = None
+    deep_dive_questions: str | None = None
+    errors: dict[str, str] = {} # 失敗した結果の名前 -> エラー内容 (他の結果はそのまま返す)
+
+INSIGHT_PARTS = {
+    "classification": classify_text,
+    "analysis": analyze_text,
+    "deep_dive_questions": deep_dive_text,
+}
+
+async def _run_part(name: str, user_text: str) -> tuple[str, object]:
+    try:
+        return name, await INSIGHT_PARTS[name](user_text)
+    except (AdmissionRejected, RequestCancelled):
+        raise
+    except Exception as e:
+        logger.error("Error during feedback insight (%s): %s", name, e)
+        return name, e
+
+def _error_detail(error: Exception) -> str:
+    return str(error.detail if isinstance(error, HTTPException) else error)
+
+def _combine(results: list[tuple[str, object]]) -> InsightResponse:
+    response = InsightResponse()
+    for name, value in results:
+        if isinstance(value, Exception):
+            response.errors[name] = _error_detail(value)
+        else:
+            setattr(response, name, value)
+    if len(response.errors) == len(INSIGHT_PARTS):
+        # すべて失敗した場合は個別のエンドポイントと同じく500を返す
+        raise HTTPException(status_code=500, detail=f"フィードバックの分析中にエラーが発生しました: {response.errors}")
+    return response
+
+@router.post("/feedback-insights")
+async def feedback_insights(request: InsightRequest, http_request: Request):
+    # 分類・分析・深掘り質問を1回のリクエストで受け、アドミッション制御の空きスロット (LLM_PARALLEL_SLOTS) の分だけ同時に生成する
+    user_text = request.text
+
+    with request_scope(http_request, INSIGHTS_DEADLINE):
+        # 3つのプロンプトで共通の入力テキストのトークン数と埋め込みを先に1回だけ取得する (各処理ではキャッシュに当たる)。
+        # どちらも生成と同じくアドミッション制御を通るので、各処理が個別に上流へ送ることはない
+        await asyncio.gather(count_tokens(user_text), semantic_cache.warm(user_text))
+        # タスクは作成時のコンテキスト (リクエストの期限) を引き継ぐ
+        tasks = [asyncio.create_task(_run_part(name, user_text)) for name in INSIGHT_PARTS]
+
+    if not request.stream:
+        try:
+            results = await asyncio.gather(*tasks)
+        except BaseException:
+            for task in tasks:
+                task.cancel()
+            raise
+        return _combine(results)
+
+    async def events():
+        results = []
+        try:
+            # 完了した順に結果を返し、最後に全体をまとめて返す
+            for next_result in asyncio.as_completed(tasks):
+                name, value = await next_result
+                results.append((name, value))
+                if isinstance(value, Exception):
+                    yield format_sse("part", {"part": name, "error": _error_detail(value)})
+                else:
+                    result = value.model_dump() if isinstance(value, BaseModel) else value
+                    yield format_sse("part", {"part": name, "result": result})
+            yield format_sse("done", _combine(results).model_dump())
+        except HTTPException as e:
+            logger.error("Error during feedback insight streaming: %s", e.detail)
+            yield format_sse("error", {"status_code": e.status_code, "detail": e.detail})
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
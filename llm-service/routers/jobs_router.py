@@ -0,0 +1,89 @@
+import asyncio
+import logging
+from fastapi import APIRouter, Header, HTTPException, Response
+from pydantic import BaseModel, Field, ValidationError
+from services.backend_pool import LLM_PARALLEL_SLOTS
+from services.job_queue import JobConflict, job_queue, job_view
+from routers.feedback_router import BatchClassificationItem, BatchClassificationRequest, TextClassificationRequest, classify_text
+from routers.rephrase_router import AnalyzeRequest as RephraseRequest, get_app_workflow, make_initial_state, record_workflow_result
+
+logger = logging.getLogger(__name__)
+
+router = APIRouter()
+
+class JobSubmitRequest(BaseModel):
+    kind: str # classify | classify_batch | rephrase
+    payload: dict # 各エンドポイントと同じリクエストボディ
+    callback_url: str | None = None # 指定すると完了時にジョブの内容をPOSTする (LLM_JOB_CALLBACK_HOSTSのホストのみ)
+    max_attempts: int | None = Field(default=None, ge=1, le=10)
+    idempotency_key: str | None = None # Idempotency-Keyヘッダーでも指定できる
+
+async def run_classify_job(payload: dict) -> dict:
+    request = TextClassificationRequest.model_validate(payload)
+    return (await classify_text(request.text)).model_dump()
+
+async def run_classify_batch_job(payload: dict) -> dict:
+    request = BatchClassificationRequest.model_validate(payload)
+    semaphore = asyncio.Semaphore(LLM_PARALLEL_SLOTS)
+
+    async def classify_item(index: int, text: str) -> BatchClassificationItem:
+        async with semaphore:
+            try:
+                return BatchClassificationItem(index=index, result=await classify_text(text))
+            except Exception as e:
+                # 1件の失敗でジョブ全体をやり直さないよう、エラーは項目ごとに返す
+                detail = e.detail if isinstance(e, HTTPException) else str(e)
+                return BatchClassificationItem(index=index, error=str(detail))
+
+    items = await asyncio.gather(*(classify_item(i, text) for i, text in enumerate(request.texts)))
+    return {"items": [item.model_dump(exclude_none=True) for item in items]}
+
+async def run_rephrase_job(payload: dict) -> dict:
+    request = RephraseRequest.model_validate(payload)
+    result = await get_app_workflow().ainvoke(make_initial_state(request.text, False, request.mode))
+    record_workflow_result(result)
+    return {"reply": result["final_reply"]}
+
+JOB_PAYLOAD_MODELS = {
+    "classify": TextClassificationRequest,
+    "classify_batch": BatchClassificationRequest,
+    "rephrase": RephraseRequest,
+}
+job_queue.register("classify", run_classify_job)
+job_queue.register("classify_batch", run_classify_batch_job)
+job_queue.register("rephrase", run_rephrase_job)
+
+@router.post("/jobs", status_code=202)
+async def submit_job(request: JobSubmitRequest, response: Response, idempotency_key: str | None = Header(default=None)):
+    # 長時間かかる処理を登録してすぐに返す。結果は GET /jobs/{job_id} か callback_url で受け取る
+    model = JOB_PAYLOAD_MODELS.get(request.kind)
+    if model is None:
+        raise HTTPException(status_code=422, detail=f"Unknown job kind: {request.kind} (expected one of {job_queue.kinds})")
+    try:
+        model.model_validate(request.payload)
+    except ValidationError as e:
+        raise HTTPException(status_code=422, detail=e.errors(include_url=False, include_input=False))
+
+    try:
+        job, created = await job_queue.submit(
+            request.kind,
+            request.payload,
+            idempotency_key=idempotency_key or request.idempotency_key,
+            callback_url=request.callback_url,
+            max_attempts=request.max_attempts,
+        )
+    except JobConflict:
+        raise HTTPException(status_code=409, detail="Idempotency key was already used for a different job.")
+
+    if not created:
+        # 同じ冪等キーの再送: 既存のジョブをそのまま返す
+        response.status_code = 200
+    response.headers["Location"] = f"/jobs/{job['id']}"
+    return job_view(job)
+
+@router.get("/jobs/{job_id}")
+async def get_job(job_id: str):
+    job = await job_queue.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found.")
+    return job_view(job)
@@ -1,81 +1,249 @@
-import traceback
+import logging
 from opentelemetry import trace # OpenTelemetryのインポート
-from fastapi import APIRouter, HTTPException
-from langgraph.graph import StateGraph, END
+from fastapi import APIRouter, HTTPException, Request
 from pydantic import BaseModel
-from typing import TypedDict, Annotated
+from typing import TypedDict, Annotated, Literal
 import operator
+import asyncio
+import os
+import time
+from difflib import SequenceMatcher
 
-from services.llm_service import call_llm
+from services.llm_service import complete_llm, stream_llm
+from services.sse import sse_response
+from services.admission import AdmissionRejected
+from services.request_scope import RequestCancelled, raise_if_cancelled, request_scope
+from services.context_manager import count_tokens
 from prompts.rephrase import REPHRASE_PROMPT
 from prompts.refine_rephrase import REFINE_REPHRASE_PROMPT
+from services.telemetry import set_text_attribute
+from services.startup import startup
+
+logger = logging.getLogger(__name__)
+
+# 適応型ワークフローの設定
+REPHRASE_DEFAULT_MODE = os.getenv("REPHRASE_DEFAULT_MODE", "adaptive") # adaptive | fast | full
+REPHRASE_MAX_TOKENS = 1000
+REPHRASE_DEADLINE = float(os.getenv("REPHRASE_DEADLINE", "120")) # 秒。2パス分を見込んだリクエスト全体の期限 (0以下で無期限)
+# 入力トークン数に対する生成上限の倍率。REPHRASE_MAX_LENGTH_RATIOより大きくし、冗長な出力は打ち切られる前に too_long で検出する
+REPHRASE_BUDGET_RATIO = float(os.getenv("REPHRASE_BUDGET_RATIO", "2.0"))
+REPHRASE_BUDGET_MIN = int(os.getenv("REPHRASE_BUDGET_MIN", "64"))
+REPHRASE_MIN_LENGTH_RATIO = float(os.getenv("REPHRASE_MIN_LENGTH_RATIO", "0.4")) # これより短ければ要約しすぎ
+REPHRASE_MAX_LENGTH_RATIO = float(os.getenv("REPHRASE_MAX_LENGTH_RATIO", "1.6")) # これより長ければ冗長 (文字数の比)
+REPHRASE_MAX_SIMILARITY = float(os.getenv("REPHRASE_MAX_SIMILARITY", "0.9")) # これより似ていればほぼ未変更
+# プロンプトの見出しや説明が出力に漏れている場合はリファインで取り除く
+REPHRASE_ARTIFACT_MARKERS = ("###", "[テキスト]", "[再構成されたテキスト]", "Translation", "翻訳:", "説明:")
+if REPHRASE_MAX_LENGTH_RATIO >= REPHRASE_BUDGET_RATIO:
+    logger.warning(
+        "REPHRASE_MAX_LENGTH_RATIO (%.2f) should be below REPHRASE_BUDGET_RATIO (%.2f), otherwise cut-off output passes the length check",
+        REPHRASE_MAX_LENGTH_RATIO, REPHRASE_BUDGET_RATIO,
+    )
 
 # LangGraphの状態定義
 class RephraseState(TypedDict):
     user_text: str
     llm_reply: str
     final_reply: str
+    stream: bool
+    mode: str
+    refine_reason: str
+    finish_reason: str # 初回出力のfinish_reason ("length" ならmax_tokensで打ち切られた)
+    node_timings: Annotated[list, operator.add] # (ノード名, 所要時間ms)
+
+async def token_budget(text: str) -> int:
+    # 再構成の出力は入力と同程度の長さなので、入力のトークン数から生成上限を決める
+    return min(REPHRASE_MAX_TOKENS, int(await count_tokens(text) * REPHRASE_BUDGET_RATIO) + REPHRASE_BUDGET_MIN)
+
+async def generate(state: RephraseState, prompt: str, max_tokens: int, final: bool) -> tuple[str, str | None]:
+    if final and state.get("stream"):
+        from langgraph.config import get_stream_writer
+
+        # 最終ノードの出力はstream_mode="custom"でクライアントまで流す
+        writer = get_stream_writer()
+        chunks = []
+        async for token in stream_llm(
+            prompt,
+            max_tokens=max_tokens,
+            stop=["\n\n"],
+            temperature=0.0,
+        ):
+            chunks.append(token)
+            writer(token)
+        # ストリーミングした最終出力は作り直せないので、finish_reasonは使わない
+        return "".join(chunks).strip(), None
+    return await complete_llm(
+        prompt,
+        max_tokens=max_tokens,
+        stop=["\n\n"],
+        temperature=0.0,
+    )
 
 # LangGraphノード: 初期リフレーズ
 async def initial_rephrase_node(state: RephraseState) -> RephraseState:
     tracer = trace.get_tracer(__name__)
     with tracer.start_as_current_span("langgraph.node.initial_rephrase") as span:
+        await raise_if_cancelled()
+        started = time.perf_counter()
         user_text = state["user_text"]
         prompt = REPHRASE_PROMPT.format(user_text=user_text)
-        llm_reply = await call_llm(
-            prompt,
-            max_tokens=1000,
-            stop=["\n\n"],
-            temperature=0.0,
-        )
-        span.set_attribute("output.value", llm_reply)
-        return {"llm_reply": llm_reply}
+        max_tokens = await token_budget(user_text)
+        # fastモードではこのノードが最終出力になる
+        final = state["mode"] == "fast"
+        llm_reply, finish_reason = await generate(state, prompt, max_tokens, final)
+        if finish_reason == "length" and max_tokens < REPHRASE_MAX_TOKENS:
+            # 生成上限で打ち切られた: 上限を広げて1回だけやり直す
+            span.add_event("rephrase.retry_truncated", {"llm.max_tokens": max_tokens})
+            max_tokens = REPHRASE_MAX_TOKENS
+            llm_reply, finish_reason = await generate(state, prompt, max_tokens, final)
+        elapsed_ms = (time.perf_counter() - started) * 1000
+        span.set_attribute("llm.max_tokens", max_tokens)
+        span.set_attribute("llm.finish_reason", finish_reason or "")
+        set_text_attribute(span, "output.value", llm_reply)
+        span.set_attribute("langgraph.node.duration_ms", elapsed_ms)
+        return {"llm_reply": llm_reply, "finish_reason": finish_reason or "", "node_timings": [("initial_rephrase", elapsed_ms)]}
+
+def refine_decision(state: RephraseState) -> str:
+    """初回出力を安価にチェックし、リファインが必要な理由を返す (不要なら空文字列)。"""
+    if state["mode"] == "fast":
+        return ""
+    if state["mode"] == "full":
+        return "full_mode"
+
+    user_text = state["user_text"].strip()
+    llm_reply = state["llm_reply"]
+    if not llm_reply:
+        return "empty_output"
+    if state.get("finish_reason") == "length":
+        # 上限を広げても打ち切られた出力は、長さが範囲内でも途中で切れている
+        return "truncated"
+    length_ratio = len(llm_reply) / max(len(user_text), 1)
+    if length_ratio < REPHRASE_MIN_LENGTH_RATIO:
+        return "too_short"
+    if length_ratio > REPHRASE_MAX_LENGTH_RATIO:
+        return "too_long"
+    if any(marker in llm_reply for marker in REPHRASE_ARTIFACT_MARKERS):
+        return "prompt_artifacts"
+    if SequenceMatcher(None, user_text, llm_reply).ratio() > REPHRASE_MAX_SIMILARITY:
+        return "unchanged"
+    return ""
+
+def route_after_initial(state: RephraseState) -> str:
+    return "refine_rephrase" if refine_decision(state) else "accept_initial"
+
+# LangGraphノード: 初回出力をそのまま採用 (リファインをスキップ)
+async def accept_initial_node(state: RephraseState) -> RephraseState:
+    if state.get("stream") and state["mode"] != "fast":
+        from langgraph.config import get_stream_writer
+
+        # 初回ノードはストリーミングしていないので、ここでまとめて流す
+        get_stream_writer()(state["llm_reply"])
+    return {"final_reply": state["llm_reply"], "refine_reason": ""}
 
 # LangGraphノード: リファインリフレーズ
 async def refine_rephrase_node(state: RephraseState) -> RephraseState:
     tracer = trace.get_tracer(__name__)
     with tracer.start_as_current_span("langgraph.node.refine_rephrase") as span:
+        # 初回の生成中にクライアントが去っていれば、2回目の生成は始めない
+        await raise_if_cancelled()
+        started = time.perf_counter()
         llm_reply = state["llm_reply"]
         prompt = REFINE_REPHRASE_PROMPT.format(input_text=llm_reply)
-        refined_reply = await call_llm(
-            prompt,
-            max_tokens=1000, # Adjust as needed
-            stop=["\n\n"],
-            temperature=0.0,
-        )
-        span.set_attribute("output.value", refined_reply)
-        return {"final_reply": refined_reply}
+        max_tokens = await token_budget(llm_reply)
+        refined_reply, _ = await generate(state, prompt, max_tokens, final=True)
+        elapsed_ms = (time.perf_counter() - started) * 1000
+        reason = refine_decision(state)
+        span.set_attribute("llm.max_tokens", max_tokens)
+        span.set_attribute("rephrase.refine_reason", reason)
+        set_text_attribute(span, "output.value", refined_reply)
+        span.set_attribute("langgraph.node.duration_ms", elapsed_ms)
+        return {"final_reply": refined_reply, "refine_reason": reason, "node_timings": [("refine_rephrase", elapsed_ms)]}
+
+_app_workflow = None
 
-# LangGraphワークフローの構築
-workflow = StateGraph(RephraseState)
-workflow.add_node("initial_rephrase", initial_rephrase_node)
-workflow.add_node("refine_rephrase", refine_rephrase_node)
+def get_app_workflow():
+    """LangGraphのワークフローを返す。LangGraphのimportと構築は起動時間を延ばすので、初回利用時 (または起動時の温め) に行う。"""
+    global _app_workflow
+    if _app_workflow is None:
+        from langgraph.graph import StateGraph, END
 
-workflow.set_entry_point("initial_rephrase")
-workflow.add_edge("initial_rephrase", "refine_rephrase")
-workflow.set_finish_point("refine_rephrase")
+        # LangGraphワークフローの構築
+        workflow = StateGraph(RephraseState)
+        workflow.add_node("initial_rephrase", initial_rephrase_node)
+        workflow.add_node("accept_initial", accept_initial_node)
+        workflow.add_node("refine_rephrase", refine_rephrase_node)
 
-app_workflow = workflow.compile() # FastAPIのappと名前が衝突しないように変更
+        workflow.set_entry_point("initial_rephrase")
+        # 初回出力が十分なら2回目の生成を省略する
+        workflow.add_conditional_edges("initial_rephrase", route_after_initial, ["refine_rephrase", "accept_initial"])
+        workflow.add_edge("accept_initial", END)
+        workflow.add_edge("refine_rephrase", END)
+
+        _app_workflow = workflow.compile() # FastAPIのappと名前が衝突しないように変更
+    return _app_workflow
+
+startup.register_task("rephrase_workflow", lambda: asyncio.to_thread(get_app_workflow))
+startup.register_prompt("rephrase", REPHRASE_PROMPT)
+startup.register_prompt("refine_rephrase", REFINE_REPHRASE_PROMPT)
 
 router = APIRouter()
 
 class AnalyzeRequest(BaseModel):
     text: str
+    stream: bool = False # TrueでServer-Sent Eventsとしてトークンを逐次返す
+    # adaptive: 初回出力を見てリファインの要否を判断 / fast: 1パスのみ / full: 常に2パス
+    mode: Literal["adaptive", "fast", "full"] = REPHRASE_DEFAULT_MODE
+
+def make_initial_state(user_text: str, stream: bool, mode: str) -> RephraseState:
+    return {
+        "user_text": user_text,
+        "llm_reply": "",
+        "final_reply": "",
+        "stream": stream,
+        "mode": mode,
+        "refine_reason": "",
+        "finish_reason": "",
+        "node_timings": [],
+    }
+
+def record_workflow_result(result: RephraseState):
+    span = trace.get_current_span()
+    refined = any(name == "refine_rephrase" for name, _ in result["node_timings"])
+    span.set_attribute("rephrase.mode", result["mode"])
+    span.set_attribute("rephrase.refined", refined)
+    span.set_attribute("rephrase.refine_reason", result.get("refine_reason", ""))
+    for name, elapsed_ms in result["node_timings"]:
+        span.set_attribute(f"rephrase.{name}.duration_ms", elapsed_ms)
+    timings = ", ".join(f"{name}={elapsed_ms:.0f}ms" for name, elapsed_ms in result["node_timings"])
+    logger.info("Rephrase workflow (mode=%s, refined=%s): %s", result["mode"], refined, timings)
 
 @router.post("/chat/rephrase")
-async def rephrase_text(request: AnalyzeRequest):
-    user_text = request.text
+async def rephrase_text(request: AnalyzeRequest, http_request: Request):
+    initial_state = make_initial_state(request.text, request.stream, request.mode)
 
     try:
-        # Langgraphワークフローを実行
-        result = await app_workflow.ainvoke({"user_text": user_text, "llm_reply": "", "final_reply": ""})
+        with request_scope(http_request, REPHRASE_DEADLINE):
+            if request.stream:
+                async def workflow_tokens():
+                    async for mode, chunk in get_app_workflow().astream(initial_state, stream_mode=["custom", "values"]):
+                        if mode == "custom":
+                            yield chunk
+                        else:
+                            result = chunk
+                    record_workflow_result(result)
+
+                return await sse_response(workflow_tokens())
+
+            # Langgraphワークフローを実行
+            result = await get_app_workflow().ainvoke(initial_state)
+            record_workflow_result(result)
 
-        final_reply = result["final_reply"]
+            final_reply = result["final_reply"]
         
         
-        return {"reply": final_reply}
+            return {"reply": final_reply}
 
+    except (AdmissionRejected, RequestCancelled, HTTPException):
+        raise
     except Exception as e:
-        traceback.print_exc()
-        print(f"Error during LLM rephrasing: {e}")
+        logger.exception("Error during LLM rephrasing: %s", e)
         raise HTTPException(status_code=500, detail=f"LLMテキスト再構成中にエラーが発生しました: {e}")
\ No newline at end of file
@@ -0,0 +1,155 @@
+import os
+import math
+import time
+import heapq
+import asyncio
+import itertools
+import logging
+from contextlib import asynccontextmanager
+from typing import AsyncIterator
+from fastapi import HTTPException
+from services.backend_pool import backend_pool
+from services.metrics import current_route, llm_admission_queue_depth, llm_admission_rejections, llm_queue_wait
+
+logger = logging.getLogger(__name__)
+
+# llama-serverへの同時リクエスト数の制御 (アドミッション制御)
+LLM_ADMISSION_ENABLED = os.getenv("LLM_ADMISSION_ENABLED", "true").lower() in ("1", "true", "yes")
+# 同時に上流へ送る呼び出し数。0なら各バックエンドのスロット数の合計 (HTTPはLLM_PARALLEL_SLOTS、local://はLLM_LOCAL_WORKERS)
+LLM_ADMISSION_SLOTS = int(os.getenv("LLM_ADMISSION_SLOTS", "0")) or backend_pool.slots
+# 優先度クラス: 値が小さいほど先に処理する
+PRIORITY_CLASSES = {"interactive": 0, "standard": 1, "bulk": 2}
+# 各ルートの優先度クラス (未登録のルートはstandard)
+LLM_ADMISSION_ROUTE_PRIORITIES = os.getenv(
+    "LLM_ADMISSION_ROUTE_PRIORITIES",
+    "/chat=interactive,/chat/analyze=interactive,/chat/deep_dive_questions=interactive,/feedback-insights=interactive,"
+    "/chat/rephrase=standard,/classify-feedback=standard,/classify-feedback/batch=bulk,/jobs=bulk",
+)
+# クラスごとの待ち行列の上限 (超えたら429)
+LLM_ADMISSION_QUEUE_LIMITS = os.getenv("LLM_ADMISSION_QUEUE_LIMITS", "interactive=32,standard=64,bulk=256")
+# クラスごとの最大待ち時間 (秒)。推定待ち時間がこれを超える場合や、実際に超えた場合は503
+LLM_ADMISSION_MAX_WAIT = os.getenv("LLM_ADMISSION_MAX_WAIT", "interactive=10,standard=30,bulk=120")
+LLM_ADMISSION_HOLD_EWMA_ALPHA = 0.2
+
+def _parse_mapping(value: str, cast) -> dict:
+    mapping = {}
+    for item in value.split(","):
+        if "=" in item:
+            key, val = item.rsplit("=", 1)
+            mapping[key.strip()] = cast(val.strip())
+    return mapping
+
+class AdmissionRejected(HTTPException):
+    """待ち行列が満杯、または待ち時間が長すぎるために受け付けなかった呼び出し。"""
+
+    def __init__(self, status_code: int, priority: str, reason: str, retry_after: float):
+        super().__init__(
+            status_code=status_code,
+            detail=f"LLMサーバーが混雑しています ({reason})。しばらくしてから再試行してください。",
+            headers={"Retry-After": str(max(1, math.ceil(retry_after)))},
+        )
+        self.priority = priority
+        self.reason = reason
+
+class AdmissionController:
+    """上流の同時実行数を制限し、空きスロットを優先度順 (同じ優先度では到着順) に割り当てる。"""
+
+    def __init__(self, slots: int, route_priorities: dict[str, str], queue_limits: dict[str, int], max_wait: dict[str, float]):
+        self.slots = max(slots, 1)
+        self.route_priorities = route_priorities
+        self.queue_limits = queue_limits
+        self.max_wait = max_wait
+        self.active = 0
+        self.hold_ewma = 0.0 # 秒。1回の呼び出しがスロットを占有する時間の指数移動平均
+        self._waiters: list[tuple[int, int, asyncio.Future]] = []
+        self._queued = {name: 0 for name in PRIORITY_CLASSES}
+        self._seq = itertools.count()
+
+    def priority_for_route(self, route: str) -> str:
+        return self.route_priorities.get(route, "standard")
+
+    def estimated_wait(self, priority: str) -> float:
+        # 自分より先に処理される待ち行列の長さと平均占有時間からの概算
+        rank = PRIORITY_CLASSES[priority]
+        ahead = sum(count for name, count in self._queued.items() if PRIORITY_CLASSES[name] <= rank)
+        return (ahead + 1) * self.hold_ewma / self.slots
+
+    def _reject(self, status_code: int, priority: str, reason: str, retry_after: float):
+        llm_admission_rejections.inc(priority, reason)
+        logger.warning("LLM call rejected (priority=%s, reason=%s, active=%d, queued=%s)", priority, reason, self.active, self._queued)
+        raise AdmissionRejected(status_code, priority, reason, retry_after)
+
+    async def acquire(self, priority: str) -> float:
+        """スロットを確保し、待ち時間 (秒) を返す。"""
+        if self.active < self.slots and not self._waiters:
+            self.active += 1
+            llm_queue_wait.observe(priority, value=0.0)
+            return 0.0
+
+        max_wait = self.max_wait.get(priority, 30.0)
+        estimate = self.estimated_wait(priority)
+        if self._queued[priority] >= self.queue_limits.get(priority, 64):
+            self._reject(429, priority, "queue_full", estimate)
+        if estimate > max_wait:
+            # 待っても期限内に処理できない見込みなら、待たせずにすぐ返す
+            self._reject(503, priority, "estimated_wait", estimate)
+
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (PRIORITY_CLASSES[priority], next(self._seq), future))
+        self._queued[priority] += 1
+        llm_admission_queue_depth.inc(priority)
+        started = time.perf_counter()
+        try:
+            await asyncio.wait_for(future, timeout=max_wait)
+        except asyncio.TimeoutError:
+            if not (future.done() and not future.cancelled()):
+                self._reject(503, priority, "wait_timeout", self.estimated_wait(priority))
+        except asyncio.CancelledError:
+            # 割り当て直後にキャンセルされた場合はスロットを次の待ち手に回す
+            if future.done() and not future.cancelled():
+                self.release()
+            raise
+        finally:
+            self._queued[priority] -= 1
+            llm_admission_queue_depth.dec(priority)
+        waited = time.perf_counter() - started
+        llm_queue_wait.observe(priority, value=waited)
+        return waited
+
+    def release(self, hold: float | None = None):
+        if hold is not None:
+            self.hold_ewma = hold if self.hold_ewma == 0.0 else self.hold_ewma + LLM_ADMISSION_HOLD_EWMA_ALPHA * (hold - self.hold_ewma)
+        # スロットはactiveを減らさずに次の待ち手へそのまま引き渡す
+        while self._waiters:
+            _, _, future = heapq.heappop(self._waiters)
+            if not future.done():
+                future.set_result(None)
+                return
+        self.active -= 1
+
+    @asynccontextmanager
+    async def admit(self, span=None, record_hold: bool = True) -> AsyncIterator[float]:
+        """現在のルートの優先度でスロットを確保する。キュー待ち時間はスパンにも記録する。
+
+        record_hold=False はトークン化などの短い呼び出し用で、待ち時間の推定に使う占有時間には含めない。
+        """
+        if not LLM_ADMISSION_ENABLED:
+            yield 0.0
+            return
+        priority = self.priority_for_route(current_route.get())
+        waited = await self.acquire(priority)
+        if span is not None:
+            span.set_attribute("llm.admission.priority", priority)
+            span.set_attribute("llm.admission.queue_wait_ms", waited * 1000)
+        started = time.perf_counter()
+        try:
+            yield waited
+        finally:
+            self.release(time.perf_counter() - started if record_hold else None)
+
+admission = AdmissionController(
+    LLM_ADMISSION_SLOTS,
+    _parse_mapping(LLM_ADMISSION_ROUTE_PRIORITIES, str),
+    _parse_mapping(LLM_ADMISSION_QUEUE_LIMITS, int),
+    _parse_mapping(LLM_ADMISSION_MAX_WAIT, float),
+)
@@ -0,0 +1,191 @@
+import os
+import time
+import asyncio
+import hashlib
+import logging
+import httpx
+from services.metrics import llm_backend_healthy, llm_backend_outstanding
+from services.local_engine import LLM_LOCAL_WORKERS, LOCAL_ENGINE_SCHEME
+
+logger = logging.getLogger(__name__)
+
+# 複数のllama-serverレプリカへの振り分け設定
+# LLM_SERVER_URLS (カンマ区切り) が未設定なら LLM_SERVER_URL の1台だけを使う
+LLM_SERVER_URLS = os.getenv("LLM_SERVER_URLS", "") or os.getenv("LLM_SERVER_URL", "http://llama-server:8000")
+# llama_cpp.server には /health が無い。/v1/models は生成と同じモデルのロックを待つため、長い生成中にタイムアウトする上、
+# 待っている間に処理中のストリームを打ち切らせてしまう。ロックを取らない /openapi.json で死活だけを確認する
+# (llama.cppのllama-serverなら、モデルのロード中に503を返す /health がよい)
+LLM_HEALTH_CHECK_PATH = os.getenv("LLM_HEALTH_CHECK_PATH", "/openapi.json")
+LLM_HEALTH_CHECK_INTERVAL = float(os.getenv("LLM_HEALTH_CHECK_INTERVAL", "5.0")) # 秒。0以下で無効
+LLM_HEALTH_CHECK_TIMEOUT = float(os.getenv("LLM_HEALTH_CHECK_TIMEOUT", "2.0"))
+LLM_BREAKER_FAILURE_THRESHOLD = int(os.getenv("LLM_BREAKER_FAILURE_THRESHOLD", "3")) # 連続失敗でこのバックエンドを外す
+LLM_BREAKER_COOLDOWN = float(os.getenv("LLM_BREAKER_COOLDOWN", "15.0")) # 秒。経過後に1リクエストだけ試して復帰を判断
+LLM_LATENCY_EWMA_ALPHA = 0.2
+# 1台のllama-serverの並列スロット数 (バッチ処理の同時実行数)。llama_cpp.server は1件ずつしか処理しないので1。
+# llama.cppのllama-serverを --parallel N で動かす場合はNにする
+LLM_PARALLEL_SLOTS = int(os.getenv("LLM_PARALLEL_SLOTS", "1"))
+
+CLOSED = "closed" # 通常
+OPEN = "open" # 切り離し中
+HALF_OPEN = "half_open" # 試行リクエストの結果待ち
+
+class NoBackendAvailable(Exception):
+    pass
+
+class Backend:
+    """1台のllama-serverと、その負荷・遅延・サーキットブレーカーの状態。"""
+
+    def __init__(self, url: str):
+        self.url = url.rstrip("/")
+        self.outstanding = 0 # 処理中のリクエスト数
+        self.latency_ewma = 0.0 # 秒。成功したリクエストの指数移動平均
+        self.state = CLOSED
+        self.failures = 0 # 連続失敗数
+        self.opened_at = 0.0
+        self.trial_in_flight = False
+        self.healthy = False # 直近のヘルスチェックの結果
+        # 同時に処理できる数。local:// はワーカープロセスの数、HTTPのレプリカはLLM_PARALLEL_SLOTS
+        self.slots = LLM_LOCAL_WORKERS if self.url.startswith(LOCAL_ENGINE_SCHEME) else LLM_PARALLEL_SLOTS
+
+    def endpoint(self, path: str) -> str:
+        return self.url + path
+
+    def available(self, now: float) -> bool:
+        if self.state == CLOSED:
+            return True
+        if self.state == OPEN:
+            return now - self.opened_at >= LLM_BREAKER_COOLDOWN
+        return not self.trial_in_flight
+
+class BackendPool:
+    def __init__(self, urls: list[str]):
+        if not urls:
+            raise ValueError("At least one LLM backend URL is required.")
+        self.backends = [Backend(url) for url in urls]
+        self._health_task: asyncio.Task | None = None
+        for backend in self.backends:
+            llm_backend_healthy.set(backend.url, value=1)
+
+    def __len__(self) -> int:
+        return len(self.backends)
+
+    @property
+    def slots(self) -> int:
+        """全バックエンドで同時に処理できる数 (アドミッション制御のスロット数の既定値)。"""
+        return sum(backend.slots for backend in self.backends)
+
+    def choose(self, exclude: set[str] = frozenset(), affinity: str | None = None) -> Backend:
+        """処理中のリクエストが最も少ないバックエンドを選ぶ。affinityが指定されれば同じキーは同じバックエンドに寄せる。"""
+        now = time.monotonic()
+        candidates = [b for b in self.backends if b.url not in exclude and b.available(now)]
+        if not candidates:
+            raise NoBackendAvailable("No healthy LLM backend is available.")
+        if affinity is not None:
+            # セッションのKVキャッシュは特定のサーバーにしか無いので、そのサーバーが使える限り固定する
+            digest = hashlib.sha256(affinity.encode("utf-8")).digest()
+            preferred = self.backends[int.from_bytes(digest[:8], "big") % len(self.backends)]
+            if preferred in candidates:
+                candidates = [preferred]
+        backend = min(candidates, key=lambda b: (b.outstanding, b.latency_ewma))
+        if backend.state == OPEN:
+            # クールダウン明け: この1リクエストで復帰できるか試す
+            backend.state = HALF_OPEN
+        if backend.state == HALF_OPEN:
+            backend.trial_in_flight = True
+        return backend
+
+    def has_candidate(self, exclude: set[str]) -> bool:
+        # フェイルオーバー先は、直近のヘルスチェックに通ったバックエンドに限る
+        now = time.monotonic()
+        return any(b.url not in exclude and b.healthy and b.available(now) for b in self.backends)
+
+    def acquire(self, backend: Backend):
+        backend.outstanding += 1
+        llm_backend_outstanding.inc(backend.url)
+
+    def release(self, backend: Backend):
+        backend.outstanding -= 1
+        llm_backend_outstanding.dec(backend.url)
+        # 試行リクエストが結果を残さずに終わった場合 (キャンセルなど) は次のリクエストで再度試す
+        backend.trial_in_flight = False
+
+    def record_success(self, backend: Backend, elapsed: float):
+        if backend.latency_ewma == 0.0:
+            backend.latency_ewma = elapsed
+        else:
+            backend.latency_ewma += LLM_LATENCY_EWMA_ALPHA * (elapsed - backend.latency_ewma)
+        backend.failures = 0
+        if backend.state != CLOSED:
+            logger.info("LLM backend %s re-admitted", backend.url)
+        self._close(backend)
+
+    def record_failure(self, backend: Backend, reason: str):
+        backend.failures += 1
+        backend.trial_in_flight = False
+        if backend.state == HALF_OPEN or backend.failures >= LLM_BREAKER_FAILURE_THRESHOLD:
+            self._open(backend, reason)
+
+    def _open(self, backend: Backend, reason: str):
+        if backend.state != OPEN and not any(b is not backend and b.state != OPEN for b in self.backends):
+            # 最後の1台は外さない (外しても振り分け先が無くなり、全リクエストが失敗するだけになる)
+            logger.warning("LLM backend %s is failing (%s, failures=%d), but kept in rotation as the last backend", backend.url, reason, backend.failures)
+            backend.state = CLOSED
+            backend.trial_in_flight = False
+            return
+        if backend.state != OPEN:
+            logger.warning("LLM backend %s ejected (%s, failures=%d)", backend.url, reason, backend.failures)
+        backend.state = OPEN
+        backend.opened_at = time.monotonic()
+        backend.trial_in_flight = False
+        llm_backend_healthy.set(backend.url, value=0)
+
+    def _close(self, backend: Backend):
+        backend.state = CLOSED
+        backend.trial_in_flight = False
+        llm_backend_healthy.set(backend.url, value=1)
+
+    async def check_health(self, client: httpx.AsyncClient):
+        """全バックエンドのヘルスチェックを並行して行い、結果をサーキットブレーカーに反映する。"""
+        await asyncio.gather(*(self._check_backend(client, backend) for backend in self.backends))
+
+    async def _check_backend(self, client: httpx.AsyncClient, backend: Backend):
+        try:
+            response = await client.get(backend.endpoint(LLM_HEALTH_CHECK_PATH), timeout=LLM_HEALTH_CHECK_TIMEOUT)
+            # llama.cppのllama-serverはモデルのロード中に503を返す
+            healthy = response.status_code == 200
+            reason = f"health check status {response.status_code}"
+        except httpx.HTTPError as e:
+            healthy = False
+            reason = f"health check {type(e).__name__}"
+        backend.healthy = healthy
+        if healthy:
+            if backend.state == OPEN:
+                logger.info("LLM backend %s passed health check, re-admitted", backend.url)
+                self._close(backend)
+            backend.failures = 0
+        else:
+            # 1回の失敗 (切れたkeep-alive接続など) では外さず、リクエストの失敗と同じく連続失敗数で判断する
+            self.record_failure(backend, reason)
+
+    async def _health_loop(self, client: httpx.AsyncClient):
+        while True:
+            try:
+                await self.check_health(client)
+            except Exception as e:
+                logger.exception("LLM backend health check failed: %s", e)
+            await asyncio.sleep(LLM_HEALTH_CHECK_INTERVAL)
+
+    def start_health_checks(self, client: httpx.AsyncClient):
+        if LLM_HEALTH_CHECK_INTERVAL > 0 and self._health_task is None:
+            self._health_task = asyncio.create_task(self._health_loop(client))
+
+    async def stop_health_checks(self):
+        if self._health_task is not None:
+            self._health_task.cancel()
+            try:
+                await self._health_task
+            except asyncio.CancelledError:
+                pass
+            self._health_task = None
+
+backend_pool = BackendPool([url.strip() for url in LLM_SERVER_URLS.split(",") if url.strip()])
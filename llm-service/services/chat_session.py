@@ -0,0 +1,68 @@
+import os
+import time
+import asyncio
+import itertools
+from collections import OrderedDict
+from services.backend_pool import LLM_PARALLEL_SLOTS
+
+# サーバー側チャットセッションの設定
+CHAT_SESSION_MAX = int(os.getenv("CHAT_SESSION_MAX", "256")) # 保持するセッション数の上限 (超えたらLRUで破棄)
+CHAT_SESSION_IDLE_TTL = float(os.getenv("CHAT_SESSION_IDLE_TTL", "1800")) # 秒。これ以上使われていないセッションは破棄
+CHAT_SESSION_SLOT_PINNING = os.getenv("CHAT_SESSION_SLOT_PINNING", "true").lower() in ("1", "true", "yes")
+
+class ChatSession:
+    """構築済みの履歴を保持し、新しいメッセージ分だけを追記するチャットセッション。"""
+
+    def __init__(self, session_id: str, system_prompt: str, slot_id: int):
+        self.session_id = session_id
+        self.system_prompt = system_prompt
+        self.history: list[str] = [] # 1行1メッセージの整形済み履歴
+        self.summary = "" # コンテキストからあふれた古いターンのローリング要約
+        self.slot_id = slot_id
+        self.turns = 0
+        self.last_used = time.monotonic()
+        self.lock = asyncio.Lock() # 同一セッションのターンを直列化する
+
+    def llm_params(self) -> dict:
+        # 同じスロットに固定し、llama-serverのKVキャッシュ(プロンプトの共通接頭辞)を再利用させる
+        if not CHAT_SESSION_SLOT_PINNING:
+            return {"cache_prompt": True}
+        return {"id_slot": self.slot_id, "cache_prompt": True}
+
+class ChatSessionStore:
+    def __init__(self, max_sessions: int, idle_ttl: float, slots: int):
+        self.max_sessions = max_sessions
+        self.idle_ttl = idle_ttl
+        self._sessions: OrderedDict[str, ChatSession] = OrderedDict()
+        self._slot_counter = itertools.count()
+        self._slots = max(slots, 1)
+
+    def _evict_idle(self):
+        now = time.monotonic()
+        while self._sessions:
+            session_id, session = next(iter(self._sessions.items()))
+            if now - session.last_used < self.idle_ttl:
+                break
+            del self._sessions[session_id]
+
+    def get_or_create(self, session_id: str, system_prompt: str) -> tuple[ChatSession, bool]:
+        """セッションを返す。戻り値の2番目は新規作成されたかどうか。"""
+        self._evict_idle()
+        session = self._sessions.get(session_id)
+        created = session is None
+        if created:
+            session = ChatSession(session_id, system_prompt, next(self._slot_counter) % self._slots)
+            self._sessions[session_id] = session
+            while len(self._sessions) > self.max_sessions:
+                self._sessions.popitem(last=False)
+        session.last_used = time.monotonic()
+        self._sessions.move_to_end(session_id)
+        return session, created
+
+    def delete(self, session_id: str) -> bool:
+        return self._sessions.pop(session_id, None) is not None
+
+    def __len__(self) -> int:
+        return len(self._sessions)
+
+chat_sessions = ChatSessionStore(CHAT_SESSION_MAX, CHAT_SESSION_IDLE_TTL, LLM_PARALLEL_SLOTS)
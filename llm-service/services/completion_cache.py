@@ -0,0 +1,145 @@
+import os
+import json
+import time
+import asyncio
+import hashlib
+import sqlite3
+import threading
+from collections import OrderedDict
+from typing import Awaitable, Callable
+
+# 決定的(低temperature)な補完結果のキャッシュ設定
+LLM_CACHE_ENABLED = os.getenv("LLM_CACHE_ENABLED", "true").lower() in ("1", "true", "yes")
+LLM_CACHE_MAX_TEMPERATURE = float(os.getenv("LLM_CACHE_MAX_TEMPERATURE", "0.2")) # これ以下のtemperatureのみキャッシュ対象
+LLM_CACHE_MAX_ENTRIES = int(os.getenv("LLM_CACHE_MAX_ENTRIES", "1024"))
+LLM_CACHE_TTL = float(os.getenv("LLM_CACHE_TTL", "86400")) # 秒
+LLM_CACHE_DB_PATH = os.getenv("LLM_CACHE_DB_PATH", "") # 空の場合はディスク層を使わない
+
+def make_cache_key(prompt: str, max_tokens: int, stop: list, temperature: float, extra_params: dict | None = None) -> str:
+    payload = json.dumps([prompt, max_tokens, stop, temperature, extra_params or {}], ensure_ascii=False, sort_keys=True)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+class _DiskTier:
+    """再起動後も残るSQLiteのキャッシュ層。ブロッキングI/Oはスレッドで実行する。"""
+
+    def __init__(self, path: str):
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        with self._lock:
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS completions (key TEXT PRIMARY KEY, value TEXT NOT NULL, expires_at REAL NOT NULL)"
+            )
+            self._conn.execute("DELETE FROM completions WHERE expires_at <= ?", (time.time(),))
+            self._conn.commit()
+
+    def get(self, key: str) -> tuple[str, float] | None:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT value, expires_at FROM completions WHERE key = ? AND expires_at > ?", (key, time.time())
+            ).fetchone()
+        return (row[0], row[1]) if row else None
+
+    def set(self, key: str, value: str, expires_at: float):
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO completions (key, value, expires_at) VALUES (?, ?, ?)", (key, value, expires_at)
+            )
+            self._conn.commit()
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+class CompletionCache:
+    """TTL付きLRU(メモリ) + 任意のSQLite層 + 同一プロンプトのsingle-flight合流。"""
+
+    def __init__(self, max_entries: int, ttl: float, db_path: str = ""):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries: OrderedDict[str, tuple[str, float]] = OrderedDict()
+        self._inflight: dict[str, asyncio.Future] = {}
+        self._disk = _DiskTier(db_path) if db_path else None
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+
+    def _get_memory(self, key: str) -> str | None:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        value, expires_at = entry
+        if expires_at <= time.time():
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return value
+
+    def _set_memory(self, key: str, value: str, expires_at: float):
+        self._entries[key] = (value, expires_at)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    async def get_or_generate(self, key: str, generate: Callable[[], Awaitable[str]], should_store: Callable[[str], bool] | None = None) -> tuple[str, str]:
+        """キャッシュから値を返すか、生成して保存する。戻り値は (値, "hit" | "miss" | "coalesced")。
+
+        should_storeがFalseを返した値 (途中で打ち切られた生成など) は保存しない (進行中の同じキーの待ち手には共有する)。
+        """
+        value = self._get_memory(key)
+        if value is not None:
+            self.hits += 1
+            return value, "hit"
+
+        # 同じキーの生成が進行中なら、その結果を共有する
+        inflight = self._inflight.get(key)
+        if inflight is not None:
+            try:
+                value = await asyncio.shield(inflight)
+            except asyncio.CancelledError:
+                # 先行リクエストがキャンセルされた場合は自分で生成し直す
+                if inflight.cancelled() and not asyncio.current_task().cancelling():
+                    return await self.get_or_generate(key, generate, should_store)
+                raise
+            self.coalesced += 1
+            return value, "coalesced"
+
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[key] = future
+        try:
+            if self._disk is not None:
+                row = await asyncio.to_thread(self._disk.get, key)
+                if row is not None:
+                    value, expires_at = row
+                    self._set_memory(key, value, expires_at)
+                    self.hits += 1
+                    future.set_result(value)
+                    return value, "hit"
+
+            self.misses += 1
+            value = await generate()
+            if should_store is None or should_store(value):
+                expires_at = time.time() + self.ttl
+                self._set_memory(key, value, expires_at)
+                if self._disk is not None:
+                    await asyncio.to_thread(self._disk.set, key, value, expires_at)
+            future.set_result(value)
+            return value, "miss"
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except BaseException as e:
+            future.set_exception(e)
+            future.exception() # 待機者がいない場合の未取得警告を抑止
+            raise
+        finally:
+            self._inflight.pop(key, None)
+
+    def close(self):
+        if self._disk is not None:
+            self._disk.close()
+            self._disk = None
+
+completion_cache = CompletionCache(LLM_CACHE_MAX_ENTRIES, LLM_CACHE_TTL, LLM_CACHE_DB_PATH)
+
+def is_cacheable(temperature: float) -> bool:
+    return LLM_CACHE_ENABLED and temperature <= LLM_CACHE_MAX_TEMPERATURE
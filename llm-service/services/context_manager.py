@@ -0,0 +1,175 @@
+import os
+import hashlib
+import logging
+from collections import OrderedDict
+import httpx
+from opentelemetry import trace
+from services.llm_service import call_llm, post_to_llm
+from services.backend_pool import NoBackendAvailable
+from services.admission import admission
+from prompts.summarize_history import SUMMARIZE_HISTORY_PROMPT
+
+logger = logging.getLogger(__name__)
+
+# llama-serverのコンテキスト長 (docker-composeのN_CTXと合わせる)
+LLM_N_CTX = int(os.getenv("LLM_N_CTX", "4096"))
+LLM_CONTEXT_MARGIN = int(os.getenv("LLM_CONTEXT_MARGIN", "64")) # トークン数の誤差に備えた余白
+# llama_cpp.server は /extras/tokenize/count ({"input"} -> {"count"})、llama.cppのllama-serverは /tokenize ({"content"} -> {"tokens"})
+LLM_TOKENIZE_PATH = os.getenv("LLM_TOKENIZE_PATH", "/extras/tokenize/count")
+TOKEN_COUNT_CACHE_SIZE = int(os.getenv("TOKEN_COUNT_CACHE_SIZE", "4096"))
+# 古いターンの扱い: "summarize" はローリング要約に圧縮、"trim" は単純に切り捨てる
+CHAT_CONTEXT_STRATEGY = os.getenv("CHAT_CONTEXT_STRATEGY", "summarize")
+CHAT_SUMMARY_MAX_TOKENS = int(os.getenv("CHAT_SUMMARY_MAX_TOKENS", "200"))
+
+SUMMARY_HEADER = "[これまでの対話の要約]\n"
+
+_token_counts: OrderedDict[str, int] = OrderedDict()
+_tokenize_supported = True # 404が返ったらサーバーにトークン化APIが無いとみなし、以降は概算だけを使う
+
+def _estimate_tokens(text: str) -> int:
+    # /tokenizeが使えない場合の保守的な概算 (日本語は1文字あたり約1.5トークン)
+    return len(text.encode("utf-8")) // 2 + 1
+
+def _tokenize_payload(text: str) -> dict:
+    # リクエストの形はLLM_TOKENIZE_PATHのサーバーの種類に合わせる
+    if LLM_TOKENIZE_PATH.startswith("/extras/"):
+        return {"input": text}
+    return {"content": text, "add_special": False}
+
+def _cached_count(text: str) -> int | None:
+    if not text:
+        return 0
+    key = hashlib.sha256(text.encode("utf-8")).hexdigest()
+    count = _token_counts.get(key)
+    if count is not None:
+        _token_counts.move_to_end(key)
+    return count
+
+def _store_count(text: str, count: int):
+    _token_counts[hashlib.sha256(text.encode("utf-8")).hexdigest()] = count
+    while len(_token_counts) > TOKEN_COUNT_CACHE_SIZE:
+        _token_counts.popitem(last=False)
+
+async def count_tokens(text: str) -> int:
+    """llama-serverのトークン化API (LLM_TOKENIZE_PATH) でトークン数を数える。結果はテキスト単位でキャッシュする。"""
+    return (await count_tokens_many([text]))[0]
+
+async def count_tokens_many(texts: list[str]) -> list[int]:
+    """複数のテキストのトークン数を、アドミッションのスロット1つの中で順に数える。
+
+    llama_cpp.serverのトークン化は生成と同じモデルのロックを取り、処理中のストリームを打ち切らせる
+    (interrupt_requests) ため、生成と同じくアドミッション制御を通す。
+    """
+    counts = [_cached_count(text) for text in texts]
+    missing = list(dict.fromkeys(text for text, count in zip(texts, counts) if count is None))
+    if missing and _tokenize_supported:
+        async with admission.admit(record_hold=False):
+            for text in missing:
+                count = await _tokenize(text)
+                if count is None:
+                    break
+                _store_count(text, count)
+    # トークン化できなかったものは概算値 (キャッシュしないので次は正確な値を取り直す)
+    return [count if count is not None else (_cached_count(text) or _estimate_tokens(text)) for text, count in zip(texts, counts)]
+
+async def _tokenize(text: str) -> int | None:
+    global _tokenize_supported
+    try:
+        output = await post_to_llm(LLM_TOKENIZE_PATH, _tokenize_payload(text))
+        return output["count"] if "count" in output else len(output["tokens"])
+    except httpx.HTTPStatusError as e:
+        if e.response.status_code == 404:
+            _tokenize_supported = False
+            logger.warning("LLM server has no %s, using token estimates from now on (set LLM_TOKENIZE_PATH)", LLM_TOKENIZE_PATH)
+        else:
+            logger.warning("Tokenize failed, falling back to estimate: %s", e)
+    except (httpx.HTTPError, NoBackendAvailable, KeyError, ValueError) as e:
+        logger.warning("Tokenize failed, falling back to estimate: %s", e)
+    return None
+
+def prompt_budget(max_tokens: int) -> int:
+    # プロンプトに使えるトークン数 = コンテキスト長 - 生成分 - 余白
+    return LLM_N_CTX - max_tokens - LLM_CONTEXT_MARGIN
+
+async def _truncate_to_budget(text: str, text_tokens: int, budget: int) -> str:
+    # 文字数をトークン比で縮め、収まるまで詰める
+    truncated = text
+    while text_tokens > budget and truncated:
+        truncated = truncated[:max(int(len(truncated) * budget / text_tokens) - 1, 0)]
+        text_tokens = await count_tokens(truncated)
+    return truncated
+
+async def summarize_turns(turns: list[str], previous_summary: str = "") -> str:
+    """turnsを既存の要約に畳み込む。要約プロンプトもコンテキストに収まるよう、収まる分ずつ順に要約する。"""
+    budget = prompt_budget(CHAT_SUMMARY_MAX_TOKENS)
+    turn_counts = await count_tokens_many(turns)
+    summary = previous_summary
+    start = 0
+    while start < len(turns):
+        fixed = await count_tokens(SUMMARIZE_HISTORY_PROMPT.format(previous_summary=summary or "なし", conversation=""))
+        chunk: list[str] = []
+        used = 0
+        for turn, count in zip(turns[start:], turn_counts[start:]):
+            if chunk and fixed + used + count > budget:
+                break
+            chunk.append(turn)
+            used += count
+        start += len(chunk)
+        if fixed + used > budget:
+            # 1ターンだけで予算を超える場合は末尾を切り詰める
+            chunk = [await _truncate_to_budget(chunk[0], used, max(budget - fixed, 0))]
+        prompt = SUMMARIZE_HISTORY_PROMPT.format(previous_summary=summary or "なし", conversation="".join(chunk))
+        # temperature 0.0 なので同じ履歴の要約は補完キャッシュから返る
+        summary = await call_llm(prompt, max_tokens=CHAT_SUMMARY_MAX_TOKENS, stop=["\n\n"], temperature=0.0)
+    return summary
+
+async def fit_history(header: str, turns: list[str], footer: str, max_tokens: int, previous_summary: str = "", strategy: str = CHAT_CONTEXT_STRATEGY) -> tuple[str, int, str]:
+    """新しいターンから順に予算内に収まるだけ残し、あふれた古いターンは要約または切り捨てる。
+
+    戻り値は (header + 要約 + 残ったターン + footer のプロンプト, 省いたターン数, 要約)。
+    要約は呼び出し側で保持し、次回はprevious_summaryとして渡して新たに省いたターンだけを畳み込む。
+    """
+    tracer = trace.get_tracer(__name__)
+    with tracer.start_as_current_span("context.fit_history") as span:
+        fixed, *turn_counts = await count_tokens_many([header + footer, *turns])
+        budget = prompt_budget(max_tokens) - fixed
+        span.set_attribute("context.budget_tokens", budget)
+
+        summary_block = f"{SUMMARY_HEADER}{previous_summary}\n" if previous_summary else ""
+        if sum(turn_counts) + await count_tokens(summary_block) <= budget:
+            span.set_attribute("context.dropped_turns", 0)
+            return f"{header}{summary_block}{''.join(turns)}{footer}", 0, previous_summary
+
+        # 要約用の枠を確保したうえで、新しいターンから残す
+        if strategy == "summarize":
+            budget -= CHAT_SUMMARY_MAX_TOKENS + await count_tokens(SUMMARY_HEADER)
+        kept = 0
+        used = 0
+        for count in reversed(turn_counts):
+            if used + count > budget:
+                break
+            used += count
+            kept += 1
+        dropped = turns[:len(turns) - kept]
+        recent = turns[len(turns) - kept:]
+
+        summary = ""
+        if strategy == "summarize" and (dropped or previous_summary):
+            summary = await summarize_turns(dropped, previous_summary) if dropped else previous_summary
+        summary_block = f"{SUMMARY_HEADER}{summary}\n" if summary else ""
+
+        span.set_attribute("context.dropped_turns", len(dropped))
+        span.set_attribute("context.used_tokens", used + fixed)
+        return f"{header}{summary_block}{''.join(recent)}{footer}", len(dropped), summary
+
+async def fit_text(template: str, text: str, max_tokens: int) -> str:
+    """template.format(user_text=text) がコンテキストに収まるよう、長すぎるテキストの末尾を切り詰める。"""
+    fixed, text_tokens = await count_tokens_many([template.format(user_text=""), text])
+    budget = prompt_budget(max_tokens) - fixed
+    if text_tokens <= budget:
+        return text
+
+    truncated = await _truncate_to_budget(text, text_tokens, budget)
+    logger.info("Input text truncated to fit context: %d -> %d chars", len(text), len(truncated))
+    trace.get_current_span().set_attribute("context.truncated_chars", len(text) - len(truncated))
+    return truncated
@@ -0,0 +1,432 @@
+import os
+import json
+import time
+import uuid
+import random
+import asyncio
+import hashlib
+import logging
+import socket
+import sqlite3
+import threading
+from typing import Awaitable, Callable
+from urllib.parse import urlsplit
+import httpx
+from fastapi import HTTPException
+from pydantic import ValidationError
+from opentelemetry import trace
+from services.backend_pool import LLM_PARALLEL_SLOTS
+from services.metrics import current_route, llm_job_retries, llm_jobs_finished
+
+logger = logging.getLogger(__name__)
+
+# 非同期ジョブキューの設定
+LLM_JOB_DB_PATH = os.getenv("LLM_JOB_DB_PATH", "./data/jobs.sqlite3")
+LLM_JOB_WORKERS = int(os.getenv("LLM_JOB_WORKERS", str(LLM_PARALLEL_SLOTS))) # 同時に実行するジョブ数
+LLM_JOB_MAX_QUEUED = int(os.getenv("LLM_JOB_MAX_QUEUED", "10000")) # 未完了ジョブの上限 (超えたら投入を429で拒否)
+LLM_JOB_MAX_ATTEMPTS = int(os.getenv("LLM_JOB_MAX_ATTEMPTS", "3"))
+LLM_JOB_RETRY_BASE_DELAY = float(os.getenv("LLM_JOB_RETRY_BASE_DELAY", "2.0")) # 秒。試行ごとに2倍 (ジッター付き)
+LLM_JOB_RETRY_MAX_DELAY = float(os.getenv("LLM_JOB_RETRY_MAX_DELAY", "300.0"))
+LLM_JOB_POLL_INTERVAL = float(os.getenv("LLM_JOB_POLL_INTERVAL", "1.0")) # 秒。再試行待ちのジョブを拾う間隔
+LLM_JOB_RETENTION = float(os.getenv("LLM_JOB_RETENTION", "604800")) # 秒。完了したジョブを保持する期間
+LLM_JOB_PURGE_INTERVAL = float(os.getenv("LLM_JOB_PURGE_INTERVAL", "3600")) # 秒。保持期間を過ぎたジョブを削除する間隔
+# 秒。実行中のジョブのリース期間。実行中は1/3ごとに延長し、延長されずに切れたジョブ (プロセスの異常終了) だけを待ち行列に戻す
+LLM_JOB_LEASE = float(os.getenv("LLM_JOB_LEASE", "120"))
+LLM_JOB_CALLBACK_TIMEOUT = float(os.getenv("LLM_JOB_CALLBACK_TIMEOUT", "10.0"))
+# callback_urlに指定できるスキームとホスト (カンマ区切り)。ホストが未設定ならコールバックは受け付けない (内部ネットワークへのSSRF対策)
+LLM_JOB_CALLBACK_SCHEMES = {s.strip() for s in os.getenv("LLM_JOB_CALLBACK_SCHEMES", "https").split(",") if s.strip()}
+LLM_JOB_CALLBACK_HOSTS = {h.strip().lower() for h in os.getenv("LLM_JOB_CALLBACK_HOSTS", "").split(",") if h.strip()}
+# ジョブ内のLLM呼び出しはこのルートとして扱う (アドミッション制御の優先度とメトリクスのラベル)
+JOB_ROUTE = "/jobs"
+
+# ジョブを実行しているプロセスの識別子 (同じDBを共有する複数のワーカープロセスやレプリカを区別する)
+JOB_OWNER = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+QUEUED = "queued"
+RUNNING = "running"
+SUCCEEDED = "succeeded"
+FAILED = "failed"
+
+JobHandler = Callable[[dict], Awaitable[dict]]
+
+class JobConflict(Exception):
+    """同じ冪等キーで内容の異なるジョブが投入された。"""
+
+class _JobStore:
+    """ジョブをSQLiteに永続化する。ブロッキングI/Oはスレッドで実行する。"""
+
+    def __init__(self, path: str):
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.row_factory = sqlite3.Row
+        with self._lock:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                """CREATE TABLE IF NOT EXISTS jobs (
+                    id TEXT PRIMARY KEY,
+                    kind TEXT NOT NULL,
+                    payload TEXT NOT NULL,
+                    status TEXT NOT NULL,
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    max_attempts INTEGER NOT NULL,
+                    run_after REAL NOT NULL,
+                    idempotency_key TEXT UNIQUE,
+                    request_hash TEXT NOT NULL,
+                    callback_url TEXT,
+                    result TEXT,
+                    error TEXT,
+                    created_at REAL NOT NULL,
+                    updated_at REAL NOT NULL,
+                    finished_at REAL,
+                    locked_by TEXT,
+                    lease_until REAL
+                )"""
+            )
+            # リースの列が無い古いDBに追加する
+            columns = {row["name"] for row in self._conn.execute("PRAGMA table_info(jobs)")}
+            for column, type_ in (("locked_by", "TEXT"), ("lease_until", "REAL")):
+                if column not in columns:
+                    self._conn.execute(f"ALTER TABLE jobs ADD COLUMN {column} {type_}")
+            self._conn.execute("CREATE INDEX IF NOT EXISTS jobs_ready ON jobs (status, run_after)")
+            self._conn.commit()
+
+    def insert(self, kind: str, payload: dict, max_attempts: int, idempotency_key: str | None, callback_url: str | None) -> tuple[dict, bool]:
+        """ジョブを登録する。戻り値の2番目は新規作成されたかどうか (冪等キーが既存なら既存のジョブを返す)。"""
+        request_hash = hashlib.sha256(json.dumps([kind, payload], ensure_ascii=False, sort_keys=True).encode("utf-8")).hexdigest()
+        now = time.time()
+        with self._lock:
+            if idempotency_key is not None:
+                row = self._conn.execute("SELECT * FROM jobs WHERE idempotency_key = ?", (idempotency_key,)).fetchone()
+                if row is not None:
+                    if row["request_hash"] != request_hash:
+                        raise JobConflict(idempotency_key)
+                    return dict(row), False
+            job_id = uuid.uuid4().hex
+            self._conn.execute(
+                "INSERT INTO jobs (id, kind, payload, status, max_attempts, run_after, idempotency_key, request_hash, callback_url, created_at, updated_at)"
+                " VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (job_id, kind, json.dumps(payload, ensure_ascii=False), QUEUED, max_attempts, now, idempotency_key, request_hash, callback_url, now, now),
+            )
+            self._conn.commit()
+            return dict(self._conn.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()), True
+
+    def get(self, job_id: str) -> dict | None:
+        with self._lock:
+            row = self._conn.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return dict(row) if row else None
+
+    def count_pending(self) -> int:
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM jobs WHERE status IN (?, ?)", (QUEUED, RUNNING)).fetchone()[0]
+
+    def claim_next(self, owner: str) -> dict | None:
+        """実行可能なジョブを1件取り出し、ownerのリースを付けて実行中にする。
+
+        同じDBを使う他のプロセスと取り合っても二重に実行しないよう、status='queued' を条件にしたUPDATEで確保する。
+        """
+        with self._lock:
+            while True:
+                now = time.time()
+                row = self._conn.execute(
+                    "SELECT * FROM jobs WHERE status = ? AND run_after <= ? ORDER BY run_after, created_at LIMIT 1", (QUEUED, now)
+                ).fetchone()
+                if row is None:
+                    return None
+                cursor = self._conn.execute(
+                    "UPDATE jobs SET status = ?, attempts = attempts + 1, locked_by = ?, lease_until = ?, updated_at = ? WHERE id = ? AND status = ?",
+                    (RUNNING, owner, now + LLM_JOB_LEASE, now, row["id"], QUEUED),
+                )
+                self._conn.commit()
+                if cursor.rowcount == 1:
+                    break
+                # 他のプロセスが先に確保した
+        job = dict(row)
+        job["attempts"] += 1
+        job["status"] = RUNNING
+        job["locked_by"] = owner
+        return job
+
+    def renew_lease(self, job_id: str, owner: str) -> bool:
+        """リースを延長する。Falseなら既に他のプロセスに引き継がれている。"""
+        now = time.time()
+        with self._lock:
+            cursor = self._conn.execute(
+                "UPDATE jobs SET lease_until = ?, updated_at = ? WHERE id = ? AND status = ? AND locked_by = ?",
+                (now + LLM_JOB_LEASE, now, job_id, RUNNING, owner),
+            )
+            self._conn.commit()
+            return cursor.rowcount == 1
+
+    def finish(self, job_id: str, owner: str, status: str, result: dict | None, error: str | None) -> bool:
+        now = time.time()
+        with self._lock:
+            cursor = self._conn.execute(
+                "UPDATE jobs SET status = ?, result = ?, error = ?, locked_by = NULL, lease_until = NULL, updated_at = ?, finished_at = ?"
+                " WHERE id = ? AND status = ? AND locked_by = ?",
+                (status, json.dumps(result, ensure_ascii=False) if result is not None else None, error, now, now, job_id, RUNNING, owner),
+            )
+            self._conn.commit()
+            return cursor.rowcount == 1
+
+    def retry_later(self, job_id: str, owner: str, run_after: float, error: str) -> bool:
+        with self._lock:
+            cursor = self._conn.execute(
+                "UPDATE jobs SET status = ?, run_after = ?, error = ?, locked_by = NULL, lease_until = NULL, updated_at = ?"
+                " WHERE id = ? AND status = ? AND locked_by = ?",
+                (QUEUED, run_after, error, time.time(), job_id, RUNNING, owner),
+            )
+            self._conn.commit()
+            return cursor.rowcount == 1
+
+    def release(self, owner: str) -> int:
+        """停止するプロセスが実行中のジョブを待ち行列に戻す (中断は失敗ではないので試行回数も戻す)。"""
+        with self._lock:
+            cursor = self._conn.execute(
+                "UPDATE jobs SET status = ?, attempts = attempts - 1, locked_by = NULL, lease_until = NULL, updated_at = ?"
+                " WHERE status = ? AND locked_by = ?",
+                (QUEUED, time.time(), RUNNING, owner),
+            )
+            self._conn.commit()
+            return cursor.rowcount
+
+    def recover(self) -> tuple[int, int]:
+        """リースが切れた実行中のジョブ (異常終了したプロセスのもの) を待ち行列に戻す。
+
+        試行回数を使い切ったものは失敗にする。戻り値は (戻した数, 失敗にした数)。
+        他のプロセスが実行中のジョブはリースが延長され続けるので対象にならない。
+        """
+        now = time.time()
+        with self._lock:
+            failed = self._conn.execute(
+                "UPDATE jobs SET status = ?, error = ?, locked_by = NULL, lease_until = NULL, updated_at = ?, finished_at = ?"
+                " WHERE status = ? AND COALESCE(lease_until, 0) < ? AND attempts >= max_attempts",
+                (FAILED, "lease expired (worker process exited)", now, now, RUNNING, now),
+            ).rowcount
+            requeued = self._conn.execute(
+                "UPDATE jobs SET status = ?, locked_by = NULL, lease_until = NULL, updated_at = ? WHERE status = ? AND COALESCE(lease_until, 0) < ?",
+                (QUEUED, now, RUNNING, now),
+            ).rowcount
+            self._conn.commit()
+            return requeued, failed
+
+    def purge(self, before: float) -> int:
+        with self._lock:
+            cursor = self._conn.execute("DELETE FROM jobs WHERE status IN (?, ?) AND finished_at < ?", (SUCCEEDED, FAILED, before))
+            self._conn.commit()
+            return cursor.rowcount
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+def _is_retryable(e: Exception) -> bool:
+    # 入力の誤り (4xx、検証エラー) は何度やっても失敗するので再試行しない。429 (混雑) は再試行する
+    if isinstance(e, (ValidationError, ValueError, KeyError, TypeError)):
+        return False
+    if isinstance(e, HTTPException):
+        return e.status_code >= 500 or e.status_code == 429
+    return True
+
+def callback_url_error(url: str) -> str | None:
+    """callback_urlが許可リストに無ければ理由を返す。"""
+    parts = urlsplit(url)
+    if parts.scheme not in LLM_JOB_CALLBACK_SCHEMES:
+        return f"callback_url scheme must be one of {sorted(LLM_JOB_CALLBACK_SCHEMES)}"
+    if not parts.hostname or parts.hostname.lower() not in LLM_JOB_CALLBACK_HOSTS:
+        return "callback_url host is not allowed (LLM_JOB_CALLBACK_HOSTS)"
+    return None
+
+def _retry_delay(attempt: int) -> float:
+    delay = min(LLM_JOB_RETRY_BASE_DELAY * 2 ** (attempt - 1), LLM_JOB_RETRY_MAX_DELAY)
+    return delay * random.uniform(0.5, 1.0)
+
+class JobQueue:
+    """SQLiteに永続化したジョブを、上限付きのワーカーで順に実行する。"""
+
+    def __init__(self, db_path: str, workers: int):
+        self.db_path = db_path
+        self.workers = max(workers, 1)
+        self._handlers: dict[str, JobHandler] = {}
+        self._store: _JobStore | None = None
+        self._tasks: list[asyncio.Task] = []
+        self._wakeup: asyncio.Event | None = None
+        self._callback_client: httpx.AsyncClient | None = None
+
+    def register(self, kind: str, handler: JobHandler):
+        self._handlers[kind] = handler
+
+    @property
+    def kinds(self) -> list[str]:
+        return sorted(self._handlers)
+
+    async def start(self):
+        self._store = await asyncio.to_thread(_JobStore, self.db_path)
+        recovered, expired = await asyncio.to_thread(self._store.recover)
+        purged = await asyncio.to_thread(self._store.purge, time.time() - LLM_JOB_RETENTION)
+        logger.info(
+            "Job queue ready (db=%s, owner=%s, workers=%d, recovered=%d, expired=%d, purged=%d)",
+            self.db_path, JOB_OWNER, self.workers, recovered, expired, purged,
+        )
+        self._wakeup = asyncio.Event()
+        # コールバック先への接続は使い回す (リダイレクトは追わない)
+        self._callback_client = httpx.AsyncClient(timeout=LLM_JOB_CALLBACK_TIMEOUT, follow_redirects=False)
+        self._tasks = [asyncio.create_task(self._worker(i)) for i in range(self.workers)]
+        self._tasks.append(asyncio.create_task(self._maintenance_loop()))
+
+    async def stop(self):
+        # 実行中のジョブは中断し、すぐに待ち行列へ戻す (他のプロセスか次回の起動で再実行する)
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        if self._store is not None:
+            try:
+                released = await asyncio.to_thread(self._store.release, JOB_OWNER)
+            except sqlite3.Error as e:
+                # 戻せなかったジョブはリースが切れた後に戻る
+                logger.exception("Failed to release running jobs: %s", e)
+            else:
+                if released:
+                    logger.info("Released %d running jobs back to the queue", released)
+        if self._callback_client is not None:
+            await self._callback_client.aclose()
+            self._callback_client = None
+        if self._store is not None:
+            self._store.close()
+            self._store = None
+
+    async def submit(self, kind: str, payload: dict, idempotency_key: str | None = None, callback_url: str | None = None, max_attempts: int | None = None) -> tuple[dict, bool]:
+        if kind not in self._handlers:
+            raise ValueError(f"unknown job kind: {kind}")
+        error = callback_url_error(callback_url) if callback_url is not None else None
+        if error:
+            raise HTTPException(status_code=422, detail=error)
+        if await asyncio.to_thread(self._store.count_pending) >= LLM_JOB_MAX_QUEUED:
+            raise HTTPException(status_code=429, detail="ジョブの待ち行列が満杯です。", headers={"Retry-After": "60"})
+        job, created = await asyncio.to_thread(
+            self._store.insert, kind, payload, max_attempts or LLM_JOB_MAX_ATTEMPTS, idempotency_key, callback_url
+        )
+        if created:
+            self._wakeup.set()
+        return job, created
+
+    async def get(self, job_id: str) -> dict | None:
+        return await asyncio.to_thread(self._store.get, job_id)
+
+    async def _worker(self, index: int):
+        current_route.set(JOB_ROUTE)
+        while True:
+            try:
+                job = await asyncio.to_thread(self._store.claim_next, JOB_OWNER)
+            except sqlite3.Error as e:
+                logger.exception("Job worker %d failed to claim a job: %s", index, e)
+                job = None
+            if job is None:
+                # 新しいジョブの投入か、再試行待ちのジョブの期限まで待つ
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=LLM_JOB_POLL_INTERVAL)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            await self._run(job)
+
+    async def _maintenance_loop(self):
+        # 異常終了したプロセスのジョブ (リース切れ) を待ち行列に戻し、保持期間を過ぎたジョブを定期的に削除する
+        last_purge = time.monotonic()
+        while True:
+            await asyncio.sleep(LLM_JOB_LEASE / 2)
+            try:
+                recovered, expired = await asyncio.to_thread(self._store.recover)
+                if recovered or expired:
+                    logger.warning("Recovered %d jobs with expired leases (%d failed after max attempts)", recovered, expired)
+                    self._wakeup.set()
+                if time.monotonic() - last_purge >= LLM_JOB_PURGE_INTERVAL:
+                    last_purge = time.monotonic()
+                    purged = await asyncio.to_thread(self._store.purge, time.time() - LLM_JOB_RETENTION)
+                    if purged:
+                        logger.info("Purged %d finished jobs", purged)
+            except sqlite3.Error as e:
+                logger.exception("Job queue maintenance failed: %s", e)
+
+    async def _renew_lease(self, job: dict):
+        while True:
+            await asyncio.sleep(LLM_JOB_LEASE / 3)
+            try:
+                renewed = await asyncio.to_thread(self._store.renew_lease, job["id"], JOB_OWNER)
+            except sqlite3.Error as e:
+                logger.exception("Failed to renew the lease of job %s: %s", job["id"], e)
+                continue
+            if not renewed:
+                logger.warning("Job %s lease was lost, its result will be discarded", job["id"])
+                return
+
+    async def _run(self, job: dict):
+        tracer = trace.get_tracer(__name__)
+        with tracer.start_as_current_span("job.run") as span:
+            span.set_attribute("job.id", job["id"])
+            span.set_attribute("job.kind", job["kind"])
+            span.set_attribute("job.attempt", job["attempts"])
+            # 実行中はリースを延長し続け、他のプロセスに回収されないようにする
+            lease = asyncio.create_task(self._renew_lease(job))
+            try:
+                result = await self._handlers[job["kind"]](json.loads(job["payload"]))
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                error = e.detail if isinstance(e, HTTPException) else f"{type(e).__name__}: {e}"
+                span.set_attribute("error", True)
+                if _is_retryable(e) and job["attempts"] < job["max_attempts"]:
+                    delay = _retry_delay(job["attempts"])
+                    logger.warning("Job %s (%s) attempt %d failed, retrying in %.1fs: %s", job["id"], job["kind"], job["attempts"], delay, error)
+                    llm_job_retries.inc(job["kind"])
+                    await asyncio.to_thread(self._store.retry_later, job["id"], JOB_OWNER, time.time() + delay, str(error))
+                    return
+                logger.error("Job %s (%s) failed after %d attempts: %s", job["id"], job["kind"], job["attempts"], error)
+                await self._finish(job, FAILED, None, str(error))
+                return
+            finally:
+                lease.cancel()
+            await self._finish(job, SUCCEEDED, result, None)
+
+    async def _finish(self, job: dict, status: str, result: dict | None, error: str | None):
+        if not await asyncio.to_thread(self._store.finish, job["id"], JOB_OWNER, status, result, error):
+            # リースが切れて他のプロセスが実行し直している
+            logger.warning("Job %s finished after its lease was lost, result discarded", job["id"])
+            return
+        llm_jobs_finished.inc(job["kind"], status)
+        if job["callback_url"]:
+            await self._send_callback(job["id"], job["callback_url"])
+
+    async def _send_callback(self, job_id: str, callback_url: str):
+        # 結果の取得はポーリングでも可能なので、コールバックの失敗はログに残すだけにする
+        error = callback_url_error(callback_url)
+        if error:
+            # 投入後に許可リストから外されたホスト
+            logger.warning("Job %s callback to %s skipped: %s", job_id, callback_url, error)
+            return
+        job = await self.get(job_id)
+        try:
+            response = await self._callback_client.post(callback_url, json=job_view(job))
+            response.raise_for_status()
+        except httpx.HTTPError as e:
+            logger.warning("Job %s callback to %s failed: %s", job_id, callback_url, e)
+
+def job_view(job: dict) -> dict:
+    """APIで返すジョブの表現。"""
+    return {
+        "job_id": job["id"],
+        "kind": job["kind"],
+        "status": job["status"],
+        "attempts": job["attempts"],
+        "max_attempts": job["max_attempts"],
+        "result": json.loads(job["result"]) if job["result"] else None,
+        "error": job["error"],
+        "created_at": job["created_at"],
+        "updated_at": job["updated_at"],
+        "finished_at": job["finished_at"],
+    }
+
+job_queue = JobQueue(LLM_JOB_DB_PATH, LLM_JOB_WORKERS)
@@ -1,61 +1,394 @@
 import os
+import json
+import time
+import asyncio
 import httpx
+from typing import AsyncIterator
 from fastapi import HTTPException
 from opentelemetry import trace # OpenTelemetryのインポート
-import traceback # tracebackモジュールをインポート
+import logging
+from services.completion_cache import completion_cache, is_cacheable, make_cache_key
+from services.backend_pool import Backend, NoBackendAvailable, backend_pool
+from services.local_engine import LOCAL_ENGINE_SCHEME, LocalEngineTransport, local_engine
+from services.admission import admission
+from services.request_scope import RequestCancelled, current_request_scope, run_cancellable
+from services.metrics import current_route, llm_backend_failovers, llm_cache_results, llm_upstream_inflight, record_cancelled, record_error, record_llm_call, record_wasted
+from services.telemetry import set_prompt_attribute, set_text_attribute
 
-LLM_SERVER_URL = os.getenv("LLM_SERVER_URL", "http://llama-server:8000") # LLMサーバーのURL
+logger = logging.getLogger(__name__)
+
+LLM_SERVER_URL = os.getenv("LLM_SERVER_URL", "http://llama-server:8000") # LLMサーバーのURL (複数台はLLM_SERVER_URLS)
+
+# 共有HTTPクライアントの設定 (コネクションプールとフェーズ別タイムアウト)
+LLM_MAX_CONNECTIONS = int(os.getenv("LLM_MAX_CONNECTIONS", "32"))
+LLM_MAX_KEEPALIVE_CONNECTIONS = int(os.getenv("LLM_MAX_KEEPALIVE_CONNECTIONS", "16"))
+# 秒。llama_cpp.server (uvicorn) はアイドル5秒でkeep-alive接続を閉じるので、それより短くして閉じられた接続を再利用しない
+LLM_KEEPALIVE_EXPIRY = float(os.getenv("LLM_KEEPALIVE_EXPIRY", "4.0"))
+LLM_CONNECT_TIMEOUT = float(os.getenv("LLM_CONNECT_TIMEOUT", "5.0"))
+LLM_READ_TIMEOUT = float(os.getenv("LLM_READ_TIMEOUT", "60.0"))
+LLM_WRITE_TIMEOUT = float(os.getenv("LLM_WRITE_TIMEOUT", "10.0"))
+LLM_POOL_TIMEOUT = float(os.getenv("LLM_POOL_TIMEOUT", "10.0"))
+LLM_HTTP2 = os.getenv("LLM_HTTP2", "false").lower() in ("1", "true", "yes")
+
+# アプリのライフサイクルで共有するクライアント (startupで生成、shutdownでクローズ)
+_client: httpx.AsyncClient | None = None
+
+def create_llm_client() -> httpx.AsyncClient:
+    limits = httpx.Limits(
+        max_connections=LLM_MAX_CONNECTIONS,
+        max_keepalive_connections=LLM_MAX_KEEPALIVE_CONNECTIONS,
+        keepalive_expiry=LLM_KEEPALIVE_EXPIRY,
+    )
+    timeout = httpx.Timeout(
+        connect=LLM_CONNECT_TIMEOUT,
+        read=LLM_READ_TIMEOUT,
+        write=LLM_WRITE_TIMEOUT,
+        pool=LLM_POOL_TIMEOUT,
+    )
+    # HTTP/2を有効にする場合は h2 パッケージが必要 (httpx[http2])
+    # 送信先はリクエストごとにbackend_poolが選ぶので、base_urlは持たない
+    # local:// のバックエンドはHTTPではなく同じプロセス内のllama.cppワーカーに渡す
+    mounts = {LOCAL_ENGINE_SCHEME: LocalEngineTransport(local_engine)} if _uses_local_engine() else None
+    return httpx.AsyncClient(limits=limits, timeout=timeout, http2=LLM_HTTP2, mounts=mounts)
+
+def _uses_local_engine() -> bool:
+    return any(backend.url.startswith(LOCAL_ENGINE_SCHEME) for backend in backend_pool.backends)
+
+def get_llm_client() -> httpx.AsyncClient:
+    global _client
+    if _client is None or _client.is_closed:
+        # startup前に呼ばれた場合 (スクリプトからの直接利用など) は遅延生成する
+        _client = create_llm_client()
+    return _client
 
 async def load_llm_model():
     # LLMサーバーのURLが設定されていることを確認する
     if not LLM_SERVER_URL:
         raise HTTPException(status_code=500, detail="LLM_SERVER_URL is not set.")
-    print(f"LLM server URL set to: {LLM_SERVER_URL}")
-    # サーバーが利用可能か簡単なヘルスチェックを行うことも可能だが、ここでは省略
+    logger.info("LLM backends: %s", ", ".join(backend.url for backend in backend_pool.backends))
+    if _uses_local_engine():
+        # モデルの読み込みはワーカープロセスで行い、終わるまではヘルスチェックが503を返す
+        local_engine.start()
+    client = get_llm_client()
+    logger.info("LLM client ready (max_connections=%d, keepalive=%d, http2=%s)", LLM_MAX_CONNECTIONS, LLM_MAX_KEEPALIVE_CONNECTIONS, LLM_HTTP2)
+    # 各バックエンドを定期的にヘルスチェックし、落ちているものはローテーションから外す
+    backend_pool.start_health_checks(client)
+
+async def close_llm_client():
+    global _client
+    await backend_pool.stop_health_checks()
+    if _client is not None:
+        await _client.aclose()
+        _client = None
+
+def _is_backend_failure(e: Exception) -> bool:
+    # 接続エラー/タイムアウトと5xxはバックエンド側の障害とみなす (4xxはリクエストの問題なので切り離さない)
+    return isinstance(e, httpx.RequestError) or (isinstance(e, httpx.HTTPStatusError) and e.response.status_code >= 500)
+
+def _set_backend_attributes(span, backend: Backend, attempts: int):
+    span.set_attribute("llm.backend.url", backend.url)
+    span.set_attribute("llm.backend.outstanding", backend.outstanding)
+    span.set_attribute("llm.backend.latency_ewma_ms", backend.latency_ewma * 1000)
+    span.set_attribute("llm.backend.attempts", attempts)
+
+def _record_failover(span, backend: Backend, e: Exception):
+    logger.warning("LLM backend %s failed (%s), failing over to another replica", backend.url, type(e).__name__)
+    llm_backend_failovers.inc(backend.url)
+    span.add_event("llm.backend.failover", {"llm.backend.url": backend.url, "error.type": type(e).__name__})
+
+async def _iter_sse_events(response: httpx.Response) -> AsyncIterator[dict]:
+    async for line in response.aiter_lines():
+        # SSE形式: "data: {...}" / 終端は "data: [DONE]"
+        if not line.startswith("data:"):
+            continue
+        data = line[len("data:"):].strip()
+        if data == "[DONE]":
+            return
+        yield json.loads(data)
+
+async def _collect_stream(response: httpx.Response) -> dict:
+    """`stream: true` の補完をすべて受け取り、非ストリーミングの応答と同じ形にまとめる。"""
+    texts = []
+    finish_reason = None
+    usage = None
+    async for event in _iter_sse_events(response):
+        usage = event.get("usage") or usage
+        if event.get("choices"):
+            choice = event["choices"][0]
+            texts.append(choice.get("text", ""))
+            finish_reason = choice.get("finish_reason") or finish_reason
+    if usage is None:
+        # ストリームにusageが含まれない場合は受信したチャンク数で近似する
+        usage = {"completion_tokens": len(texts)}
+    return {"choices": [{"text": "".join(texts), "index": 0, "finish_reason": finish_reason}], "usage": usage}
+
+async def _post_to_backend(backend: Backend, path: str, payload: dict) -> dict:
+    backend_pool.acquire(backend)
+    started = time.perf_counter()
+    try:
+        if payload.get("stream"):
+            async with get_llm_client().stream("POST", backend.endpoint(path), json=payload) as response:
+                if response.is_error:
+                    await response.aread()
+                response.raise_for_status()
+                output = await _collect_stream(response)
+        else:
+            response = await get_llm_client().post(backend.endpoint(path), json=payload)
+            response.raise_for_status() # HTTPエラーが発生した場合に例外を発生させる
+            output = response.json()
+    except httpx.HTTPError as e:
+        if _is_backend_failure(e):
+            backend_pool.record_failure(backend, type(e).__name__)
+        raise
+    finally:
+        backend_pool.release(backend)
+    backend_pool.record_success(backend, time.perf_counter() - started)
+    return output
+
+async def _post_with_failover(path: str, payload: dict, max_attempts: int, affinity: str | None = None, span=None) -> tuple[dict, Backend, int]:
+    """バックエンドを選んでPOSTし、バックエンド障害ならmax_attemptsまで別のレプリカで再試行する。"""
+    tried: set[str] = set()
+    while True:
+        backend = backend_pool.choose(exclude=tried, affinity=affinity)
+        tried.add(backend.url)
+        try:
+            return await _post_to_backend(backend, path, payload), backend, len(tried)
+        except httpx.HTTPError as e:
+            if not _is_backend_failure(e) or len(tried) >= max_attempts or not backend_pool.has_candidate(tried):
+                raise
+            _record_failover(span or trace.get_current_span(), backend, e)
+
+async def post_to_llm(path: str, payload: dict) -> dict:
+    """冪等な補助API (/tokenizeなど) を最も空いているバックエンドにPOSTする。
+
+    アドミッション制御は通さないので、生成と同じロックを取るAPIは呼び出し側で admission.admit() の中から呼ぶ。
+    """
+    output, _, _ = await _post_with_failover(path, payload, len(backend_pool))
+    return output
 
-async def call_llm(prompt: str, max_tokens: int, stop: list, temperature: float):
+async def call_llm(prompt: str, max_tokens: int, stop: list, temperature: float, extra_params: dict | None = None, affinity: str | None = None):
+    # affinity: 同じ値の呼び出しは同じバックエンドに送る (チャットセッションのKVキャッシュ再利用)
+    # リクエストの期限切れやクライアントの切断を検知したら、待ち行列や上流へのHTTPリクエストごと中断する
+    completion_text, _ = await complete_llm(prompt, max_tokens, stop, temperature, extra_params, affinity)
+    return completion_text
+
+async def complete_llm(prompt: str, max_tokens: int, stop: list, temperature: float, extra_params: dict | None = None, affinity: str | None = None) -> tuple[str, str | None]:
+    """call_llmと同じだが、(生成テキスト, finish_reason) を返す。
+
+    finish_reasonが "length" ならmax_tokensで打ち切られている。キャッシュから返した場合は "stop"
+    (打ち切られた生成はキャッシュしない)、進行中の同じ呼び出しと合流した場合は不明なのでNone。
+    """
+    return await run_cancellable(_call_llm(prompt, max_tokens, stop, temperature, extra_params, affinity))
+
+async def _call_llm(prompt: str, max_tokens: int, stop: list, temperature: float, extra_params: dict | None = None, affinity: str | None = None) -> tuple[str, str | None]:
+    # 低temperatureの呼び出しは出力がほぼ決定的なので、キャッシュと同時リクエストの合流を行う
+    if not is_cacheable(temperature):
+        return await _call_llm_server(prompt, max_tokens, stop, temperature, extra_params, affinity)
+
+    tracer = trace.get_tracer(__name__)
+    with tracer.start_as_current_span("llm_cache") as span:
+        key = make_cache_key(prompt, max_tokens, stop, temperature, extra_params)
+        finish_reasons = []
+
+        async def generate() -> str:
+            completion_text, finish_reason = await _call_llm_server(prompt, max_tokens, stop, temperature, extra_params, affinity)
+            finish_reasons.append(finish_reason)
+            return completion_text
+
+        completion_text, result = await completion_cache.get_or_generate(
+            key, generate, should_store=lambda _: finish_reasons[-1] != "length"
+        )
+        span.set_attribute("llm.cache.key", key)
+        span.set_attribute("llm.cache.result", result)
+        span.set_attribute("llm.cache.hits", completion_cache.hits)
+        span.set_attribute("llm.cache.misses", completion_cache.misses)
+        span.set_attribute("llm.cache.coalesced", completion_cache.coalesced)
+        llm_cache_results.inc(result)
+        if result == "miss":
+            return completion_text, finish_reasons[-1]
+        return completion_text, "stop" if result == "hit" else None
+
+async def _call_llm_server(prompt: str, max_tokens: int, stop: list, temperature: float, extra_params: dict | None = None, affinity: str | None = None):
     tracer = trace.get_tracer(__name__) # トレーサーを取得
     with tracer.start_as_current_span("call_llm_server") as span: # 新しいスパンを開始
-        span.set_attribute("input.value", prompt)
+        set_prompt_attribute(span, "input.value", prompt)
         span.set_attribute("llm.max_tokens", max_tokens)
         span.set_attribute("llm.temperature", temperature)
 
-        try:
-            async with httpx.AsyncClient() as client:
-                response = await client.post(
-                    f"{LLM_SERVER_URL}/v1/completions",
-                    json={
-                        "prompt": prompt,
-                        "max_tokens": max_tokens,
-                        "stop": stop,
-                        "temperature": temperature,
-                        "echo": False,
-                    },
-                    timeout=60.0 # タイムアウトを設定
-                )
-                response.raise_for_status() # HTTPエラーが発生した場合に例外を発生させる
-                output = response.json()
-                
+        # llama-serverのスロットが空くまで優先度順に待つ (待ち時間は生成時間とは別に記録する)
+        async with admission.admit(span):
+            route = current_route.get()
+            llm_upstream_inflight.inc(route)
+            started = time.perf_counter()
+            payload = {
+                "prompt": prompt,
+                "max_tokens": max_tokens,
+                "stop": stop,
+                "temperature": temperature,
+                "echo": False,
+                # 応答はまとめて返すが、上流はストリーミングで受ける。llama_cpp.serverは非ストリーミングの生成を
+                # 切断後も最後まで続けるため、中断 (期限切れ・切断) で接続を閉じたときに生成を止められるのはストリーミングだけ
+                "stream": True,
+                **(extra_params or {}), # llama-server固有のパラメータ (id_slot, cache_promptなど)
+            }
+            # 低temperatureの呼び出しは冪等なので、バックエンド障害時は別のレプリカで再試行する
+            max_attempts = len(backend_pool) if is_cacheable(temperature) else 1
+            try:
+                output, backend, attempts = await _post_with_failover("/v1/completions", payload, max_attempts, affinity, span)
+                _set_backend_attributes(span, backend, attempts)
+
                 # LLMからの応答を属性として記録
                 completion_text = output["choices"][0]["text"].strip()
-                span.set_attribute("output.value", completion_text)
-
-                return completion_text
-        except httpx.HTTPStatusError as e:
-            print(f"Status code: {e.response.status_code}")
-            print(f"Response content: {e.response.text}")
-            span.set_attribute("error", True)
-            span.set_attribute("error.message", e.response.text)
-            raise HTTPException(status_code=e.response.status_code, detail=f"LLMサーバーからエラー応答: {e.response.text}")
-        except httpx.RequestError as e:
-            print(f"General httpx.RequestError: {e}")
-            traceback.print_exc()
-            span.set_attribute("error", True)
-            span.set_attribute("error.message", str(e))
-            raise HTTPException(status_code=500, detail=f"LLMサーバーへのリクエスト中にエラーが発生しました: {e}")
-        except Exception as e:
-            print(f"General exception: {e}")
-            traceback.print_exc()
-            span.set_attribute("error", True)
-            span.set_attribute("error.message", str(e))
-            raise HTTPException(status_code=500, detail=f"LLM呼び出し中に予期せぬエラーが発生しました: {e}")
\ No newline at end of file
+                set_text_attribute(span, "output.value", completion_text)
+
+                usage = output.get("usage") or {}
+                record_llm_call(time.perf_counter() - started, usage.get("prompt_tokens"), usage.get("completion_tokens"))
+
+                finish_reason = output["choices"][0].get("finish_reason")
+                span.set_attribute("llm.finish_reason", finish_reason or "")
+                return completion_text, finish_reason
+            except asyncio.CancelledError:
+                # 中断した時点までに上流が使った時間を無駄になった処理として記録する
+                elapsed = time.perf_counter() - started
+                record_wasted(elapsed)
+                span.set_attribute("llm.cancelled", True)
+                span.set_attribute("llm.wasted_ms", elapsed * 1000)
+                raise
+            except NoBackendAvailable as e:
+                record_error("NoBackendAvailable")
+                logger.error("%s", e)
+                span.set_attribute("error", True)
+                set_text_attribute(span, "error.message", str(e))
+                raise HTTPException(status_code=503, detail="利用可能なLLMサーバーがありません。")
+            except httpx.HTTPStatusError as e:
+                record_error("HTTPStatusError")
+                logger.error("Status code: %s, response content: %s", e.response.status_code, e.response.text)
+                span.set_attribute("error", True)
+                set_text_attribute(span, "error.message", e.response.text)
+                raise HTTPException(status_code=e.response.status_code, detail=f"LLMサーバーからエラー応答: {e.response.text}")
+            except httpx.RequestError as e:
+                record_error("RequestError")
+                logger.exception("General httpx.RequestError: %s", e)
+                span.set_attribute("error", True)
+                set_text_attribute(span, "error.message", str(e))
+                raise HTTPException(status_code=500, detail=f"LLMサーバーへのリクエスト中にエラーが発生しました: {e}")
+            except Exception as e:
+                record_error(type(e).__name__)
+                logger.exception("General exception: %s", e)
+                span.set_attribute("error", True)
+                set_text_attribute(span, "error.message", str(e))
+                raise HTTPException(status_code=500, detail=f"LLM呼び出し中に予期せぬエラーが発生しました: {e}")
+            finally:
+                llm_upstream_inflight.dec(route)
+
+async def stream_llm(prompt: str, max_tokens: int, stop: list, temperature: float, extra_params: dict | None = None, affinity: str | None = None) -> AsyncIterator[str]:
+    """llama-serverの `stream: true` を使い、生成されたトークンを逐次yieldする。"""
+    tracer = trace.get_tracer(__name__)
+    # ジェネレータはyieldをまたいで別のコンテキストから再開されるため、スパンはcurrentにせず手動で終了する
+    span = tracer.start_span("call_llm_server.stream")
+    # 最初のトークンを取得するまではルーターのリクエストスコープ内で実行される
+    scope = current_request_scope()
+    try:
+        set_prompt_attribute(span, "input.value", prompt)
+        span.set_attribute("llm.max_tokens", max_tokens)
+        span.set_attribute("llm.temperature", temperature)
+        span.set_attribute("llm.stream", True)
+
+        chunks = []
+        usage = {}
+        async with admission.admit(span):
+            route = current_route.get()
+            llm_upstream_inflight.inc(route)
+            started = time.perf_counter()
+            # 最初のトークンを返す前の失敗に限り、低temperatureの呼び出しは別のレプリカで再試行する
+            max_attempts = len(backend_pool) if is_cacheable(temperature) else 1
+            tried: set[str] = set()
+            try:
+                client = get_llm_client()
+                while True:
+                    backend = backend_pool.choose(exclude=tried, affinity=affinity)
+                    tried.add(backend.url)
+                    _set_backend_attributes(span, backend, len(tried))
+                    backend_pool.acquire(backend)
+                    backend_started = time.perf_counter()
+                    try:
+                        async with client.stream(
+                            "POST",
+                            backend.endpoint("/v1/completions"),
+                            json={
+                                "prompt": prompt,
+                                "max_tokens": max_tokens,
+                                "stop": stop,
+                                "temperature": temperature,
+                                "echo": False,
+                                "stream": True,
+                                **(extra_params or {}),
+                            },
+                        ) as response:
+                            if response.is_error:
+                                await response.aread()
+                            response.raise_for_status()
+
+                            async for event in _iter_sse_events(response):
+                                usage = event.get("usage") or usage
+                                token = event["choices"][0].get("text", "") if event.get("choices") else ""
+                                # call_llmの.strip()に合わせて先頭の空白は捨てる
+                                if not chunks:
+                                    token = token.lstrip()
+                                if not token:
+                                    continue
+                                if not chunks:
+                                    span.add_event("first_token")
+                                chunks.append(token)
+                                yield token
+                                if scope is not None and scope.remaining() is not None and scope.remaining() <= 0:
+                                    # 期限切れ: ここでレスポンスを閉じ、llama-serverの生成を止める
+                                    record_cancelled("deadline")
+                                    raise RequestCancelled("deadline")
+                        backend_pool.record_success(backend, time.perf_counter() - backend_started)
+                        break
+                    except httpx.HTTPError as e:
+                        if _is_backend_failure(e):
+                            backend_pool.record_failure(backend, type(e).__name__)
+                        if chunks or not _is_backend_failure(e) or len(tried) >= max_attempts or not backend_pool.has_candidate(tried):
+                            raise
+                        _record_failover(span, backend, e)
+                    finally:
+                        backend_pool.release(backend)
+
+                set_text_attribute(span, "output.value", "".join(chunks).strip())
+                # ストリームにusageが含まれない場合は受信したチャンク数で近似する
+                record_llm_call(time.perf_counter() - started, usage.get("prompt_tokens"), usage.get("completion_tokens", len(chunks)))
+            except (asyncio.CancelledError, GeneratorExit, RequestCancelled) as e:
+                # クライアントの切断 (レスポンスのキャンセル) や期限切れで生成を打ち切った
+                if chunks and not isinstance(e, RequestCancelled):
+                    # 最初のトークンより後のキャンセルはレスポンス送信中の切断によるもの
+                    record_cancelled("disconnect")
+                elapsed = time.perf_counter() - started
+                record_wasted(elapsed, len(chunks))
+                span.set_attribute("llm.cancelled", True)
+                span.set_attribute("llm.wasted_ms", elapsed * 1000)
+                span.set_attribute("llm.wasted_completion_tokens", len(chunks))
+                raise
+            except NoBackendAvailable as e:
+                record_error("NoBackendAvailable")
+                logger.error("%s", e)
+                span.set_attribute("error", True)
+                set_text_attribute(span, "error.message", str(e))
+                raise HTTPException(status_code=503, detail="利用可能なLLMサーバーがありません。")
+            except httpx.HTTPStatusError as e:
+                record_error("HTTPStatusError")
+                logger.error("Status code: %s, response content: %s", e.response.status_code, e.response.text)
+                span.set_attribute("error", True)
+                set_text_attribute(span, "error.message", e.response.text)
+                raise HTTPException(status_code=e.response.status_code, detail=f"LLMサーバーからエラー応答: {e.response.text}")
+            except httpx.RequestError as e:
+                record_error("RequestError")
+                logger.exception("General httpx.RequestError: %s", e)
+                span.set_attribute("error", True)
+                set_text_attribute(span, "error.message", str(e))
+                raise HTTPException(status_code=500, detail=f"LLMサーバーへのリクエスト中にエラーが発生しました: {e}")
+            finally:
+                llm_upstream_inflight.dec(route)
+    finally:
+        span.end()
@@ -0,0 +1,366 @@
+import os
+import json
+import asyncio
+import logging
+import importlib.util
+import multiprocessing
+from multiprocessing.connection import Connection
+from typing import AsyncIterator
+import httpx
+
+logger = logging.getLogger(__name__)
+
+# llama-cpp-pythonをllm-serviceのワーカープロセスで直接動かすバックエンド (llama-serverへのHTTPを経由しない)
+# LLM_SERVER_URLS に local://engine を含めると有効になり、HTTPのレプリカと同じようにbackend_poolから選ばれる
+# llama-cpp-python は任意の依存関係 (pip install llama-cpp-python)。親プロセスではimportしない
+LOCAL_ENGINE_SCHEME = "local://"
+LLM_LOCAL_MODEL_PATH = os.getenv("LLM_LOCAL_MODEL_PATH", "./models/mistral-7b-instruct-v0.2.Q2_K.gguf")
+LLM_LOCAL_WORKERS = int(os.getenv("LLM_LOCAL_WORKERS", "2")) # 同時に生成できる数 (アドミッション制御のスロット数にもなる)
+LLM_LOCAL_THREADS = int(os.getenv("LLM_LOCAL_THREADS", "0")) # ワーカーあたりのスレッド数。0ならCPUコア数をワーカー数で割る
+LLM_LOCAL_N_CTX = int(os.getenv("LLM_LOCAL_N_CTX", os.getenv("LLM_N_CTX", "4096")))
+LLM_LOCAL_N_GPU_LAYERS = int(os.getenv("LLM_LOCAL_N_GPU_LAYERS", "0"))
+LLM_LOCAL_EMBEDDING = os.getenv("LLM_LOCAL_EMBEDDING", "false").lower() in ("1", "true", "yes") # /v1/embeddings を使う場合 (意味的キャッシュ)
+
+# llama-serverのリクエストのうち、create_completionにそのまま渡すパラメータ
+COMPLETION_PARAMS = ("max_tokens", "temperature", "top_p", "top_k", "min_p", "stop", "echo", "seed", "repeat_penalty", "presence_penalty", "frequency_penalty")
+TERMINAL_MESSAGES = ("result", "error")
+
+def _worker_main(conn: Connection, config: dict):
+    """ワーカープロセス: モデルを読み込み、パイプで受けたリクエストを1件ずつ処理する。
+
+    重みはmmapで読み込むため、同じGGUFを開く各ワーカーはOSのページキャッシュを共有する。
+    """
+    try:
+        from llama_cpp import Llama, LlamaGrammar
+
+        llm = Llama(
+            model_path=config["model_path"],
+            n_ctx=config["n_ctx"],
+            n_threads=config["n_threads"],
+            n_gpu_layers=config["n_gpu_layers"],
+            embedding=config["embedding"],
+            use_mmap=True,
+            verbose=False,
+        )
+    except Exception as e:
+        conn.send(("failed", f"{type(e).__name__}: {e}"))
+        return
+    conn.send(("ready", os.path.basename(config["model_path"])))
+
+    while True:
+        try:
+            kind, payload = conn.recv()
+        except EOFError:
+            return
+        if kind == "stop":
+            return
+        if kind == "cancel":
+            # 生成が終わった後に届いたキャンセル
+            continue
+        try:
+            if kind == "completion":
+                _run_completion(conn, llm, LlamaGrammar, payload)
+            elif kind == "tokenize":
+                # llama.cppの /tokenize ({"content"}) と llama_cpp.server の /extras/tokenize ({"input"}) の両方を受ける
+                text = payload.get("content", payload.get("input", ""))
+                tokens = llm.tokenize(text.encode("utf-8"), add_bos=payload.get("add_special", True), special=True)
+                conn.send(("result", {"tokens": tokens, "count": len(tokens)}))
+            elif kind == "embedding":
+                conn.send(("result", llm.create_embedding(payload["input"])))
+            else:
+                conn.send(("error", (404, f"Unknown request: {kind}")))
+        except ValueError as e:
+            # プロンプトがコンテキスト長を超えた場合など
+            conn.send(("error", (400, str(e))))
+        except Exception as e:
+            conn.send(("error", (500, f"{type(e).__name__}: {e}")))
+
+def _run_completion(conn: Connection, llm, LlamaGrammar, payload: dict):
+    params = {key: payload[key] for key in COMPLETION_PARAMS if key in payload}
+    if payload.get("grammar"):
+        params["grammar"] = LlamaGrammar.from_string(payload["grammar"], verbose=False)
+    elif payload.get("json_schema"):
+        params["grammar"] = LlamaGrammar.from_json_schema(json.dumps(payload["json_schema"]), verbose=False)
+    if params.get("max_tokens") is not None and params["max_tokens"] <= 0:
+        # llama-cpp-pythonでは0以下がコンテキスト上限までの生成を意味するため、llama-serverに合わせて1にする
+        params["max_tokens"] = 1
+
+    # ストリーミングでなくてもトークン単位で生成し、トークンの合間にキャンセルを確認する
+    stream = payload.get("stream", False)
+    texts = []
+    finish_reason = None
+    for chunk in llm.create_completion(payload["prompt"], stream=True, **params):
+        choice = chunk["choices"][0]
+        texts.append(choice.get("text", ""))
+        finish_reason = choice.get("finish_reason") or finish_reason
+        if stream:
+            conn.send(("chunk", chunk))
+        if conn.poll() and conn.recv()[0] == "cancel":
+            # 親プロセスが中断した: ジェネレータを閉じて生成を止める
+            finish_reason = "cancelled"
+            break
+
+    usage = {
+        "prompt_tokens": len(llm.tokenize(payload["prompt"].encode("utf-8"))),
+        "completion_tokens": len(texts),
+    }
+    usage["total_tokens"] = usage["prompt_tokens"] + usage["completion_tokens"]
+    conn.send(("result", {
+        "object": "text_completion",
+        "choices": [{"text": "".join(texts), "index": 0, "finish_reason": finish_reason}],
+        "usage": usage,
+    }))
+
+class _Worker:
+    def __init__(self, index: int):
+        self.index = index
+        self.process: multiprocessing.Process | None = None
+        self.conn: Connection | None = None
+        self.state = "stopped" # loading | idle | busy | failed | stopped
+        self.model = ""
+
+class LocalEngine:
+    """llama-cpp-pythonのワーカープロセスのプール。各ワーカーは同時に1件だけ処理する。"""
+
+    def __init__(self, model_path: str, workers: int, threads: int, n_ctx: int, n_gpu_layers: int, embedding: bool):
+        self.config = {
+            "model_path": model_path,
+            "n_ctx": n_ctx,
+            "n_threads": threads or max(1, (os.cpu_count() or 1) // workers),
+            "n_gpu_layers": n_gpu_layers,
+            "embedding": embedding,
+        }
+        self.workers = [_Worker(i) for i in range(workers)]
+        self._context = multiprocessing.get_context("spawn")
+        self._available: asyncio.Condition | None = None
+        self._background: set[asyncio.Task] = set()
+        self._started = False
+
+    @property
+    def ready(self) -> bool:
+        return any(worker.state in ("idle", "busy") for worker in self.workers)
+
+    @property
+    def model(self) -> str:
+        return next((worker.model for worker in self.workers if worker.model), "")
+
+    def start(self):
+        if self._started:
+            return
+        if importlib.util.find_spec("llama_cpp") is None:
+            raise RuntimeError("LLM_SERVER_URLS includes local://, but llama-cpp-python is not installed (pip install llama-cpp-python).")
+        self._started = True
+        self._available = asyncio.Condition()
+        logger.info(
+            "Starting local llama.cpp engine (model=%s, workers=%d, threads=%d)",
+            self.config["model_path"], len(self.workers), self.config["n_threads"],
+        )
+        for worker in self.workers:
+            self._spawn(worker)
+
+    def _spawn(self, worker: _Worker):
+        parent_conn, child_conn = self._context.Pipe()
+        worker.process = self._context.Process(target=_worker_main, args=(child_conn, self.config), name=f"llama-worker-{worker.index}", daemon=True)
+        worker.process.start()
+        child_conn.close()
+        worker.conn = parent_conn
+        worker.state = "loading"
+        self._run_background(self._wait_loaded(worker))
+
+    def _run_background(self, coro):
+        task = asyncio.create_task(coro)
+        self._background.add(task)
+        task.add_done_callback(self._background.discard)
+
+    async def _wait_loaded(self, worker: _Worker):
+        try:
+            kind, body = await self._recv(worker)
+        except EOFError:
+            kind, body = "failed", f"exit code {worker.process.exitcode}"
+        if kind != "ready":
+            # モデルを読み込めない場合は再起動しても同じなので、ヘルスチェックで503を返し続ける
+            logger.error("Local llama.cpp worker %d failed to load the model: %s", worker.index, body)
+            worker.state = "failed"
+            await self._notify()
+            return
+        logger.info("Local llama.cpp worker %d ready (pid=%d)", worker.index, worker.process.pid)
+        worker.model = body
+        await self._release(worker)
+
+    async def _recv(self, worker: _Worker):
+        """ワーカーからの次のメッセージを、イベントループをブロックせずに待つ。"""
+        loop = asyncio.get_running_loop()
+        fd = worker.conn.fileno()
+        while not worker.conn.poll():
+            readable = loop.create_future()
+            loop.add_reader(fd, lambda: readable.done() or readable.set_result(None))
+            try:
+                await readable
+            finally:
+                loop.remove_reader(fd)
+        return worker.conn.recv()
+
+    async def _notify(self):
+        async with self._available:
+            self._available.notify_all()
+
+    async def _acquire(self, preferred: int | None) -> _Worker:
+        async with self._available:
+            while True:
+                if not any(worker.state in ("loading", "idle", "busy") for worker in self.workers):
+                    raise httpx.ConnectError("No local llama.cpp worker is running.")
+                idle = [worker for worker in self.workers if worker.state == "idle"]
+                if idle:
+                    # id_slot (チャットセッション) が指定されれば同じワーカーを優先し、プロンプトの再評価を避ける
+                    worker = next((w for w in idle if preferred is not None and w.index == preferred % len(self.workers)), idle[0])
+                    worker.state = "busy"
+                    return worker
+                await self._available.wait()
+
+    async def _release(self, worker: _Worker):
+        if worker.state != "failed":
+            worker.state = "idle"
+        await self._notify()
+
+    async def _drain(self, worker: _Worker):
+        # 中断したリクエストの終端メッセージまで読み捨ててから、ワーカーを次のリクエストに回す
+        try:
+            while (await self._recv(worker))[0] not in TERMINAL_MESSAGES:
+                pass
+        except EOFError:
+            self._restart(worker)
+            return
+        await self._release(worker)
+
+    def _restart(self, worker: _Worker):
+        logger.error("Local llama.cpp worker %d exited (code=%s), restarting", worker.index, worker.process.exitcode)
+        worker.conn.close()
+        self._spawn(worker)
+
+    async def run(self, kind: str, payload: dict) -> AsyncIterator[tuple[str, object]]:
+        """リクエストをワーカーに送り、終端 (result / error) までのメッセージを順にyieldする。
+
+        途中で閉じられた場合 (クライアントの切断や期限切れ) はワーカーに生成の中止を伝える。
+        """
+        worker = await self._acquire(payload.get("id_slot"))
+        finished = False
+        try:
+            worker.conn.send((kind, payload))
+            while not finished:
+                message = await self._recv(worker)
+                finished = message[0] in TERMINAL_MESSAGES
+                yield message
+        except (EOFError, BrokenPipeError):
+            finished = True
+            self._restart(worker)
+            raise httpx.RemoteProtocolError(f"Local llama.cpp worker {worker.index} exited during the request.")
+        finally:
+            if not finished:
+                worker.conn.send(("cancel", None))
+                self._run_background(self._drain(worker))
+            elif worker.state == "busy":
+                self._run_background(self._release(worker))
+
+    async def call(self, kind: str, payload: dict) -> tuple[str, object]:
+        messages = self.run(kind, payload)
+        try:
+            async for message in messages:
+                if message[0] in TERMINAL_MESSAGES:
+                    return message
+        finally:
+            await messages.aclose()
+
+    async def stop(self):
+        for task in list(self._background):
+            task.cancel()
+        for worker in self.workers:
+            if worker.process is None:
+                continue
+            try:
+                worker.conn.send(("stop", None))
+            except OSError:
+                pass
+            await asyncio.to_thread(worker.process.join, 5)
+            if worker.process.is_alive():
+                worker.process.kill()
+            worker.conn.close()
+            worker.state = "stopped"
+        self._started = False
+
+class _EventStream(httpx.AsyncByteStream):
+    """ワーカーのチャンクをllama-serverと同じSSE形式 (data: {...} / data: [DONE]) にする。"""
+
+    def __init__(self, first: tuple[str, object], messages: AsyncIterator[tuple[str, object]]):
+        self.first = first
+        self.messages = messages
+
+    async def __aiter__(self) -> AsyncIterator[bytes]:
+        message = self.first
+        while True:
+            kind, body = message
+            if kind == "chunk":
+                yield f"data: {json.dumps(body, ensure_ascii=False)}\n\n".encode("utf-8")
+            elif kind == "result":
+                # 最後にusageだけのイベントを送る (stream_llmがトークン数の記録に使う)
+                yield f"data: {json.dumps({'choices': [], 'usage': body['usage']})}\n\n".encode("utf-8")
+                break
+            else:
+                raise httpx.RemoteProtocolError(f"Local llama.cpp generation failed: {body[1]}")
+            message = await self.messages.__anext__()
+        yield b"data: [DONE]\n\n"
+
+    async def aclose(self):
+        await self.messages.aclose()
+
+class LocalEngineTransport(httpx.AsyncBaseTransport):
+    """local:// へのリクエストをllama-serverと同じAPIでLocalEngineに渡すhttpxのトランスポート。
+
+    共有クライアントにマウントするので、バックエンドの選択・ヘルスチェック・キャンセルはHTTPのレプリカと共通になる。
+    """
+
+    def __init__(self, engine: LocalEngine):
+        self.engine = engine
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        path = request.url.path
+        if request.method == "GET":
+            # ヘルスチェック (LLM_HEALTH_CHECK_PATH) とモデル一覧。llama-serverと同じく、モデルの読み込みが終わるまでは503
+            if not self.engine.ready:
+                return httpx.Response(503, json={"status": "loading model"})
+            return httpx.Response(200, json={"object": "list", "data": [{"id": self.engine.model, "object": "model"}]})
+
+        kinds = {
+            "/v1/completions": "completion",
+            "/tokenize": "tokenize",
+            "/extras/tokenize": "tokenize",
+            "/extras/tokenize/count": "tokenize",
+            "/v1/embeddings": "embedding",
+        }
+        if request.method != "POST" or path not in kinds:
+            return httpx.Response(404, json={"detail": "Not Found"})
+        payload = json.loads(await request.aread())
+
+        if kinds[path] == "completion" and payload.get("stream"):
+            messages = self.engine.run("completion", payload)
+            first = await messages.__anext__()
+            if first[0] == "error":
+                await messages.aclose()
+                return httpx.Response(first[1][0], json={"detail": first[1][1]})
+            return httpx.Response(200, headers={"content-type": "text/event-stream"}, stream=_EventStream(first, messages))
+
+        kind, body = await self.engine.call(kinds[path], payload)
+        if kind == "error":
+            return httpx.Response(body[0], json={"detail": body[1]})
+        return httpx.Response(200, json=body)
+
+    async def aclose(self):
+        await self.engine.stop()
+
+local_engine = LocalEngine(
+    LLM_LOCAL_MODEL_PATH,
+    LLM_LOCAL_WORKERS,
+    LLM_LOCAL_THREADS,
+    LLM_LOCAL_N_CTX,
+    LLM_LOCAL_N_GPU_LAYERS,
+    LLM_LOCAL_EMBEDDING,
+)
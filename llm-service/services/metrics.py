@@ -0,0 +1,192 @@
+from bisect import bisect_left
+from contextvars import ContextVar
+from starlette.routing import compile_path
+
+# Prometheusテキスト形式で公開する軽量なメトリクス。
+# 値の更新はイベントループ上の単純な加算だけなので、ロックを取らずイベントループもブロックしない。
+
+# 現在処理中のエンドポイント (ミドルウェアで設定し、call_llmのラベルに使う)
+current_route: ContextVar[str] = ContextVar("current_route", default="unknown")
+
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 20.0, 30.0, 60.0, 120.0)
+TOKENS_PER_SECOND_BUCKETS = (1.0, 2.0, 5.0, 10.0, 20.0, 50.0, 100.0, 200.0)
+SIMILARITY_BUCKETS = (0.5, 0.6, 0.7, 0.8, 0.85, 0.9, 0.93, 0.95, 0.97, 0.98, 0.99, 1.0)
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def _format_labels(names: tuple[str, ...], values: tuple[str, ...], extra: str = "") -> str:
+    parts = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+class _Metric:
+    type_name = ""
+
+    def __init__(self, name: str, help_text: str, labels: tuple[str, ...] = ()):
+        self.name = name
+        self.help_text = help_text
+        self.labels = labels
+        self._values: dict[tuple[str, ...], object] = {}
+
+    def _header(self) -> list[str]:
+        return [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} {self.type_name}"]
+
+class Counter(_Metric):
+    type_name = "counter"
+
+    def inc(self, *label_values: str, amount: float = 1.0):
+        self._values[label_values] = self._values.get(label_values, 0.0) + amount
+
+    def render(self) -> list[str]:
+        lines = self._header()
+        for label_values, value in self._values.items():
+            lines.append(f"{self.name}{_format_labels(self.labels, label_values)} {value}")
+        return lines
+
+class Gauge(Counter):
+    type_name = "gauge"
+
+    def dec(self, *label_values: str, amount: float = 1.0):
+        self.inc(*label_values, amount=-amount)
+
+    def set(self, *label_values: str, value: float):
+        self._values[label_values] = value
+
+class Histogram(_Metric):
+    type_name = "histogram"
+
+    def __init__(self, name: str, help_text: str, labels: tuple[str, ...] = (), buckets: tuple[float, ...] = LATENCY_BUCKETS):
+        super().__init__(name, help_text, labels)
+        self.buckets = buckets
+
+    def observe(self, *label_values: str, value: float):
+        state = self._values.get(label_values)
+        if state is None:
+            # [各バケットの件数..., +Inf], 合計, 件数
+            state = self._values[label_values] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+        state[0][bisect_left(self.buckets, value)] += 1
+        state[1] += value
+        state[2] += 1
+
+    def render(self) -> list[str]:
+        lines = self._header()
+        for label_values, (bucket_counts, total, count) in self._values.items():
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float("inf"),), bucket_counts):
+                cumulative += bucket_count
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                labels = _format_labels(self.labels, label_values, f'le="{le}"')
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labels, label_values)} {total}")
+            lines.append(f"{self.name}_count{_format_labels(self.labels, label_values)} {count}")
+        return lines
+
+llm_upstream_latency = Histogram("llm_upstream_latency_seconds", "Latency of llama-server completion calls", ("route",))
+llm_prompt_tokens = Counter("llm_prompt_tokens_total", "Prompt tokens reported by llama-server usage", ("route",))
+llm_completion_tokens = Counter("llm_completion_tokens_total", "Completion tokens reported by llama-server usage", ("route",))
+llm_tokens_per_second = Histogram("llm_tokens_per_second", "Completion tokens per second of upstream calls", ("route",), TOKENS_PER_SECOND_BUCKETS)
+llm_upstream_inflight = Gauge("llm_upstream_inflight_requests", "In-flight llama-server calls", ("route",))
+llm_http_inflight = Gauge("llm_http_inflight_requests", "In-flight HTTP requests handled by llm-service", ("route",))
+llm_errors = Counter("llm_errors_total", "LLM call errors by class", ("route", "error_class"))
+llm_cache_results = Counter("llm_cache_results_total", "Completion cache lookups by result", ("result",))
+llm_semantic_cache_results = Counter("llm_semantic_cache_results_total", "Semantic cache lookups by result", ("route", "result"))
+llm_semantic_cache_similarity = Histogram(
+    "llm_semantic_cache_similarity", "Cosine similarity of the nearest cached entry, for threshold tuning", ("route", "result"), SIMILARITY_BUCKETS
+)
+llm_backend_outstanding = Gauge("llm_backend_outstanding_requests", "Outstanding requests per llama-server backend", ("backend",))
+llm_backend_healthy = Gauge("llm_backend_healthy", "1 if the backend is in rotation, 0 if ejected by the circuit breaker", ("backend",))
+llm_queue_wait = Histogram("llm_admission_queue_wait_seconds", "Time spent waiting for an upstream slot, excluding generation", ("priority",))
+llm_admission_queue_depth = Gauge("llm_admission_queue_depth", "Calls waiting for an upstream slot", ("priority",))
+llm_admission_rejections = Counter("llm_admission_rejections_total", "Calls shed by admission control", ("priority", "reason"))
+llm_cancelled_calls = Counter("llm_cancelled_calls_total", "LLM calls aborted by deadline or client disconnect", ("route", "reason"))
+llm_wasted_seconds = Counter("llm_wasted_upstream_seconds_total", "Upstream time spent on generations that were aborted", ("route",))
+llm_wasted_completion_tokens = Counter("llm_wasted_completion_tokens_total", "Completion tokens received for streams that were aborted", ("route",))
+llm_jobs_finished = Counter("llm_jobs_finished_total", "Background jobs finished by kind and final status", ("kind", "status"))
+llm_job_retries = Counter("llm_job_retries_total", "Background job attempts scheduled for retry", ("kind",))
+llm_startup_seconds = Gauge("llm_startup_seconds", "Startup phase durations (import, wait_for_llm, warmup, ready = time to ready)", ("phase",))
+llm_ready = Gauge("llm_ready", "1 once llama-server is healthy and warm-up has finished")
+llm_backend_failovers = Counter("llm_backend_failovers_total", "Calls retried on another backend after a failure", ("backend",))
+
+REGISTRY: list[_Metric] = [
+    llm_upstream_latency,
+    llm_prompt_tokens,
+    llm_completion_tokens,
+    llm_tokens_per_second,
+    llm_upstream_inflight,
+    llm_http_inflight,
+    llm_errors,
+    llm_cache_results,
+    llm_semantic_cache_results,
+    llm_semantic_cache_similarity,
+    llm_backend_outstanding,
+    llm_backend_healthy,
+    llm_backend_failovers,
+    llm_queue_wait,
+    llm_admission_queue_depth,
+    llm_admission_rejections,
+    llm_cancelled_calls,
+    llm_wasted_seconds,
+    llm_wasted_completion_tokens,
+    llm_jobs_finished,
+    llm_job_retries,
+    llm_startup_seconds,
+    llm_ready,
+]
+
+def record_llm_call(elapsed: float, prompt_tokens: int | None, completion_tokens: int | None):
+    route = current_route.get()
+    llm_upstream_latency.observe(route, value=elapsed)
+    if prompt_tokens is not None:
+        llm_prompt_tokens.inc(route, amount=prompt_tokens)
+    if completion_tokens is not None:
+        llm_completion_tokens.inc(route, amount=completion_tokens)
+        if elapsed > 0:
+            llm_tokens_per_second.observe(route, value=completion_tokens / elapsed)
+
+def record_error(error_class: str):
+    llm_errors.inc(current_route.get(), error_class)
+
+def record_cancelled(reason: str):
+    llm_cancelled_calls.inc(current_route.get(), reason)
+
+def record_wasted(elapsed: float, completion_tokens: int | None = None):
+    # 中断された生成に使われた上流の時間 (この分だけ他のリクエストのスロットが塞がっていた)
+    route = current_route.get()
+    llm_wasted_seconds.inc(route, amount=elapsed)
+    if completion_tokens:
+        llm_wasted_completion_tokens.inc(route, amount=completion_tokens)
+
+def render_metrics() -> str:
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+class MetricsMiddleware:
+    """リクエストごとにルートをcurrent_routeへ設定し、処理中のリクエスト数を数えるASGIミドルウェア。"""
+
+    def __init__(self, app, route_paths: list[str]):
+        self.app = app
+        # パスパラメータを含むルートはテンプレートに揃えてラベルの種類が増えないようにする
+        self._patterns = [(compile_path(path)[0], path) for path in route_paths]
+
+    def _route_label(self, path: str) -> str:
+        for pattern, template in self._patterns:
+            if pattern.match(path):
+                return template
+        return "unmatched"
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["path"] == "/metrics":
+            await self.app(scope, receive, send)
+            return
+        route = self._route_label(scope["path"])
+        token = current_route.set(route)
+        llm_http_inflight.inc(route)
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            llm_http_inflight.dec(route)
+            current_route.reset(token)
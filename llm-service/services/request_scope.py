@@ -0,0 +1,111 @@
+import os
+import time
+import asyncio
+import logging
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Awaitable, Iterator, TypeVar
+from fastapi import HTTPException, Request
+from services.metrics import record_cancelled
+
+logger = logging.getLogger(__name__)
+
+# リクエスト単位の期限とクライアント切断の検知
+LLM_DISCONNECT_POLL_INTERVAL = float(os.getenv("LLM_DISCONNECT_POLL_INTERVAL", "0.5")) # 秒
+# 呼び出し元 (backend) が待てる秒数をこのヘッダーで渡すと、ルーターの既定の期限より短い場合はそちらを使う
+REQUEST_TIMEOUT_HEADER = "X-Request-Timeout"
+
+T = TypeVar("T")
+
+class RequestCancelled(HTTPException):
+    """期限切れ、またはクライアントの切断により打ち切った呼び出し。"""
+
+    def __init__(self, reason: str):
+        if reason == "deadline":
+            super().__init__(status_code=504, detail="リクエストの期限までにLLMの応答が得られませんでした。")
+        else:
+            # 499: クライアントが応答を待たずに切断した (nginxの慣例)
+            super().__init__(status_code=499, detail="クライアントが切断したためLLM呼び出しを中止しました。")
+        self.reason = reason
+
+class RequestScope:
+    def __init__(self, request: Request | None, deadline: float | None):
+        self.request = request
+        self.deadline = deadline # time.monotonic()基準。Noneなら期限なし
+
+    def remaining(self) -> float | None:
+        return None if self.deadline is None else self.deadline - time.monotonic()
+
+    async def cancelled_reason(self) -> str | None:
+        if self.deadline is not None and time.monotonic() >= self.deadline:
+            return "deadline"
+        # ボディは読み終わっている前提 (未読のボディがあると受信メッセージを消費してしまう)
+        if self.request is not None and await self.request.is_disconnected():
+            return "disconnect"
+        return None
+
+    async def wait_cancelled(self) -> str:
+        """期限切れか切断を検知するまで待ち、その理由を返す。"""
+        while True:
+            reason = await self.cancelled_reason()
+            if reason:
+                return reason
+            remaining = self.remaining()
+            interval = LLM_DISCONNECT_POLL_INTERVAL if remaining is None else min(LLM_DISCONNECT_POLL_INTERVAL, remaining)
+            await asyncio.sleep(max(interval, 0.0))
+
+_current_scope: ContextVar[RequestScope | None] = ContextVar("request_scope", default=None)
+
+def current_request_scope() -> RequestScope | None:
+    return _current_scope.get()
+
+@contextmanager
+def request_scope(request: Request | None, timeout: float) -> Iterator[RequestScope]:
+    """ルーターの処理をリクエスト単位の期限と切断検知の下で実行する。timeoutが0以下なら期限なし。"""
+    header = request.headers.get(REQUEST_TIMEOUT_HEADER) if request is not None else None
+    if header:
+        try:
+            header_timeout = float(header)
+            timeout = header_timeout if timeout <= 0 else min(timeout, header_timeout)
+        except ValueError:
+            logger.warning("Ignoring invalid %s header: %r", REQUEST_TIMEOUT_HEADER, header)
+    scope = RequestScope(request, time.monotonic() + timeout if timeout > 0 else None)
+    token = _current_scope.set(scope)
+    try:
+        yield scope
+    finally:
+        _current_scope.reset(token)
+
+async def raise_if_cancelled(scope: RequestScope | None = None):
+    """期限切れか切断済みならRequestCancelledを送出する (ワークフローのノード間などで使う)。"""
+    scope = scope or current_request_scope()
+    if scope is None:
+        return
+    reason = await scope.cancelled_reason()
+    if reason:
+        record_cancelled(reason)
+        raise RequestCancelled(reason)
+
+async def run_cancellable(awaitable: Awaitable[T]) -> T:
+    """期限切れか切断を検知したら処理中のタスクをキャンセルし、上流へのHTTPリクエストも中断する。"""
+    scope = current_request_scope()
+    if scope is None:
+        return await awaitable
+    task = asyncio.ensure_future(awaitable)
+    watcher = asyncio.create_task(scope.wait_cancelled())
+    try:
+        await asyncio.wait({task, watcher}, return_when=asyncio.FIRST_COMPLETED)
+    except asyncio.CancelledError:
+        task.cancel()
+        watcher.cancel()
+        raise
+    if task.done():
+        watcher.cancel()
+        return task.result()
+
+    reason = watcher.result()
+    task.cancel()
+    await asyncio.gather(task, return_exceptions=True)
+    record_cancelled(reason)
+    logger.info("LLM call cancelled (%s)", reason)
+    raise RequestCancelled(reason)
@@ -0,0 +1,285 @@
+import os
+import time
+import asyncio
+import hashlib
+import logging
+import sqlite3
+import threading
+from collections import OrderedDict
+from typing import AsyncIterator
+import httpx
+import numpy as np
+from opentelemetry import trace
+from services.backend_pool import NoBackendAvailable
+from services.llm_service import post_to_llm
+from services.admission import admission
+from services.metrics import llm_semantic_cache_results, llm_semantic_cache_similarity
+
+logger = logging.getLogger(__name__)
+
+# 言い回しが少し違うだけの再送を拾う、埋め込みベースの意味的キャッシュの設定
+# llama_cpp.server は --embedding true で起動したときだけ /v1/embeddings を提供する
+LLM_SEMANTIC_CACHE_ENABLED = os.getenv("LLM_SEMANTIC_CACHE_ENABLED", "false").lower() in ("1", "true", "yes")
+LLM_EMBEDDINGS_PATH = os.getenv("LLM_EMBEDDINGS_PATH", "/v1/embeddings")
+LLM_SEMANTIC_CACHE_DIR = os.getenv("LLM_SEMANTIC_CACHE_DIR", "./data/semantic_cache") # 空の場合はメモリのみ
+LLM_SEMANTIC_CACHE_MAX_ENTRIES = int(os.getenv("LLM_SEMANTIC_CACHE_MAX_ENTRIES", "4096")) # 超えたら最も使われていないものから捨てる
+LLM_SEMANTIC_CACHE_TTL = float(os.getenv("LLM_SEMANTIC_CACHE_TTL", "86400")) # 秒
+EMBEDDING_CACHE_SIZE = 256 # 同じテキストを複数のルートで引くときに埋め込みを使い回す
+# ルートごとのコサイン類似度のしきい値 (これ以上なら同じ入力とみなす)。ここにないルートはキャッシュしない
+LLM_SEMANTIC_CACHE_THRESHOLDS = os.getenv(
+    "LLM_SEMANTIC_CACHE_THRESHOLDS", "/classify-feedback=0.97,/chat/analyze=0.95,/chat/deep_dive_questions=0.95"
+)
+
+def _parse_thresholds(value: str) -> dict[str, float]:
+    thresholds = {}
+    for item in value.split(","):
+        if "=" in item:
+            route, threshold = item.rsplit("=", 1)
+            thresholds[route.strip()] = float(threshold)
+    return thresholds
+
+def _text_hash(text: str) -> str:
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+class VectorIndex:
+    """正規化済みの埋め込みを固定長のfloat32行列に並べ、内積 (=コサイン類似度) で全件検索する。
+
+    行列はNumPyのmemmap (.npy) としてディスクに置き、値などのメタデータはSQLiteに保存する。
+    メソッドはブロッキングなのでスレッドから呼ぶ。
+    """
+
+    def __init__(self, directory: str, max_entries: int):
+        self.directory = directory
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._vectors: np.ndarray | None = None # (max_entries, dim)。最初の登録で次元が決まる
+        self._namespace_ids: dict[str, int] = {}
+        self._namespaces = np.full(max_entries, -1, dtype=np.int32) # -1は空き
+        self._expires_at = np.zeros(max_entries, dtype=np.float64)
+        self._last_used = np.zeros(max_entries, dtype=np.float64)
+        self._values: list[str | None] = [None] * max_entries
+        self._slot_keys: list[tuple[int, str] | None] = [None] * max_entries
+        self._slots: dict[tuple[int, str], int] = {} # (名前空間, テキストのハッシュ) -> 行
+        self._conn: sqlite3.Connection | None = None
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+            self._conn = sqlite3.connect(os.path.join(directory, "entries.sqlite3"), check_same_thread=False)
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS entries (slot INTEGER PRIMARY KEY, namespace TEXT NOT NULL, text_hash TEXT NOT NULL, value TEXT NOT NULL, expires_at REAL NOT NULL)"
+            )
+            self._conn.commit()
+            self._load()
+
+    @property
+    def _vectors_path(self) -> str:
+        return os.path.join(self.directory, "vectors.npy")
+
+    def _load(self):
+        if not os.path.exists(self._vectors_path):
+            return
+        vectors = np.lib.format.open_memmap(self._vectors_path, mode="r+")
+        if vectors.shape[0] != self.max_entries or vectors.dtype != np.float32:
+            # 件数の設定が変わった場合は作り直す
+            logger.warning("Semantic cache index shape %s does not match max_entries=%d, resetting", vectors.shape, self.max_entries)
+            del vectors
+            os.remove(self._vectors_path)
+            self._conn.execute("DELETE FROM entries")
+            self._conn.commit()
+            return
+        self._vectors = vectors
+        now = time.time()
+        rows = self._conn.execute("SELECT slot, namespace, text_hash, value, expires_at FROM entries WHERE expires_at > ?", (now,)).fetchall()
+        for slot, namespace, text_hash, value, expires_at in rows:
+            self._assign(slot, self._namespace_id(namespace), text_hash, value, expires_at)
+            self._last_used[slot] = now
+        logger.info("Semantic cache loaded %d entries from %s", len(rows), self.directory)
+
+    def _namespace_id(self, namespace: str) -> int:
+        return self._namespace_ids.setdefault(namespace, len(self._namespace_ids))
+
+    def _assign(self, slot: int, namespace_id: int, text_hash: str, value: str, expires_at: float):
+        old_key = self._slot_keys[slot]
+        if old_key is not None:
+            self._slots.pop(old_key, None)
+        key = (namespace_id, text_hash)
+        self._slots[key] = slot
+        self._slot_keys[slot] = key
+        self._namespaces[slot] = namespace_id
+        self._values[slot] = value
+        self._expires_at[slot] = expires_at
+
+    def lookup_exact(self, namespace: str, text_hash: str) -> str | None:
+        with self._lock:
+            namespace_id = self._namespace_ids.get(namespace)
+            slot = self._slots.get((namespace_id, text_hash)) if namespace_id is not None else None
+            if slot is None or self._expires_at[slot] <= time.time():
+                return None
+            self._last_used[slot] = time.time()
+            return self._values[slot]
+
+    def search(self, namespace: str, vector: np.ndarray) -> tuple[str | None, float]:
+        """名前空間内で最も類似度の高いエントリの値と類似度を返す。"""
+        with self._lock:
+            namespace_id = self._namespace_ids.get(namespace)
+            if self._vectors is None or namespace_id is None or self._vectors.shape[1] != vector.shape[0]:
+                return None, 0.0
+            mask = (self._namespaces == namespace_id) & (self._expires_at > time.time())
+            if not mask.any():
+                return None, 0.0
+            similarities = np.where(mask, self._vectors @ vector, -np.inf)
+            slot = int(np.argmax(similarities))
+            self._last_used[slot] = time.time()
+            return self._values[slot], float(similarities[slot])
+
+    def _allocate(self) -> int:
+        # 空き行、期限切れの行、最も長く使われていない行の順に使う
+        free = np.flatnonzero(self._namespaces == -1)
+        if free.size:
+            return int(free[0])
+        expired = np.flatnonzero(self._expires_at <= time.time())
+        if expired.size:
+            return int(expired[0])
+        return int(np.argmin(self._last_used))
+
+    def insert(self, namespace: str, text_hash: str, vector: np.ndarray, value: str, ttl: float):
+        with self._lock:
+            if self._vectors is None or self._vectors.shape[1] != vector.shape[0]:
+                self._reset(vector.shape[0])
+            namespace_id = self._namespace_id(namespace)
+            slot = self._slots.get((namespace_id, text_hash))
+            if slot is None:
+                slot = self._allocate()
+            expires_at = time.time() + ttl
+            self._vectors[slot] = vector
+            self._assign(slot, namespace_id, text_hash, value, expires_at)
+            self._last_used[slot] = time.time()
+            if self._conn is not None:
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO entries (slot, namespace, text_hash, value, expires_at) VALUES (?, ?, ?, ?, ?)",
+                    (slot, namespace, text_hash, value, expires_at),
+                )
+                self._conn.commit()
+
+    def _reset(self, dim: int):
+        # 初回、または埋め込みモデルが変わって次元が変わった場合
+        if self._vectors is not None:
+            logger.warning("Embedding dimension changed (%d -> %d), clearing semantic cache", self._vectors.shape[1], dim)
+        if self.directory:
+            self._vectors = np.lib.format.open_memmap(self._vectors_path, mode="w+", dtype=np.float32, shape=(self.max_entries, dim))
+            self._conn.execute("DELETE FROM entries")
+            self._conn.commit()
+        else:
+            self._vectors = np.zeros((self.max_entries, dim), dtype=np.float32)
+        self._namespaces[:] = -1
+        self._expires_at[:] = 0.0
+        self._last_used[:] = 0.0
+        self._values = [None] * self.max_entries
+        self._slot_keys = [None] * self.max_entries
+        self._slots.clear()
+
+    def close(self):
+        with self._lock:
+            if isinstance(self._vectors, np.memmap):
+                self._vectors.flush()
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+class SemanticQuery:
+    """lookupで得た埋め込み。生成後にstoreへ渡して同じ埋め込みで登録する。"""
+
+    def __init__(self, route: str, text_hash: str, vector: np.ndarray):
+        self.route = route
+        self.text_hash = text_hash
+        self.vector = vector
+
+class SemanticCache:
+    def __init__(self, thresholds: dict[str, float], index: VectorIndex | None):
+        self.thresholds = thresholds
+        self.index = index
+        self._embeddings: OrderedDict[str, np.ndarray] = OrderedDict()
+
+    async def embed(self, text: str) -> np.ndarray:
+        key = _text_hash(text)
+        vector = self._embeddings.get(key)
+        if vector is not None:
+            self._embeddings.move_to_end(key)
+            return vector
+        vector = await self._embed(text)
+        self._embeddings[key] = vector
+        while len(self._embeddings) > EMBEDDING_CACHE_SIZE:
+            self._embeddings.popitem(last=False)
+        return vector
+
+    async def _embed(self, text: str) -> np.ndarray:
+        # 埋め込みも生成と同じモデルのロックを取るので、アドミッション制御を通す (占有時間は待ち時間の推定に含めない)
+        async with admission.admit(record_hold=False):
+            output = await post_to_llm(LLM_EMBEDDINGS_PATH, {"input": text})
+        vector = np.asarray(output["data"][0]["embedding"], dtype=np.float32)
+        if vector.ndim != 1:
+            # プーリングなしのサーバーはトークンごとの埋め込みを返すので平均する
+            vector = vector.mean(axis=0)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm > 0 else vector
+
+    async def warm(self, text: str):
+        """複数のルートで同じテキストを引く前に、埋め込みを1回だけ取得しておく。"""
+        if self.index is None:
+            return
+        try:
+            await self.embed(text.strip())
+        except (httpx.HTTPError, NoBackendAvailable, KeyError, IndexError, ValueError) as e:
+            logger.warning("Embedding failed, skipping semantic cache: %s", e)
+
+    async def lookup(self, route: str, text: str) -> tuple[str | None, SemanticQuery | None]:
+        """類似度がしきい値以上のキャッシュ済みの結果を返す。ミスの場合は生成後のstore用にクエリを返す。"""
+        if self.index is None or route not in self.thresholds:
+            return None, None
+        tracer = trace.get_tracer(__name__)
+        with tracer.start_as_current_span("semantic_cache") as span:
+            text_hash = _text_hash(text.strip())
+            value = await asyncio.to_thread(self.index.lookup_exact, route, text_hash)
+            similarity = 1.0
+            query = None
+            if value is None:
+                try:
+                    vector = await self.embed(text.strip())
+                except (httpx.HTTPError, NoBackendAvailable, KeyError, IndexError, ValueError) as e:
+                    logger.warning("Embedding failed, skipping semantic cache: %s", e)
+                    llm_semantic_cache_results.inc(route, "error")
+                    return None, None
+                query = SemanticQuery(route, text_hash, vector)
+                value, similarity = await asyncio.to_thread(self.index.search, route, vector)
+                if value is not None and similarity < self.thresholds[route]:
+                    value = None
+            result = "hit" if value is not None else "miss"
+            # ミスでも最も近かったエントリの類似度を残し、しきい値の調整に使う
+            llm_semantic_cache_results.inc(route, result)
+            llm_semantic_cache_similarity.observe(route, result, value=max(similarity, 0.0))
+            span.set_attribute("llm.semantic_cache.route", route)
+            span.set_attribute("llm.semantic_cache.result", result)
+            span.set_attribute("llm.semantic_cache.similarity", similarity)
+            span.set_attribute("llm.semantic_cache.threshold", self.thresholds[route])
+            return value, query
+
+    async def store(self, query: SemanticQuery | None, value: str):
+        if query is None or self.index is None or not value:
+            return
+        await asyncio.to_thread(self.index.insert, query.route, query.text_hash, query.vector, value, LLM_SEMANTIC_CACHE_TTL)
+
+    async def store_stream(self, query: SemanticQuery | None, tokens: AsyncIterator[str]) -> AsyncIterator[str]:
+        """トークンをそのまま流し、最後まで生成できた場合だけ結果を登録する。"""
+        chunks = []
+        async for token in tokens:
+            chunks.append(token)
+            yield token
+        await self.store(query, "".join(chunks).strip())
+
+    def close(self):
+        if self.index is not None:
+            self.index.close()
+
+semantic_cache = SemanticCache(
+    _parse_thresholds(LLM_SEMANTIC_CACHE_THRESHOLDS),
+    VectorIndex(LLM_SEMANTIC_CACHE_DIR, LLM_SEMANTIC_CACHE_MAX_ENTRIES) if LLM_SEMANTIC_CACHE_ENABLED else None,
+)
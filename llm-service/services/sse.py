@@ -0,0 +1,50 @@
+import json
+import logging
+from typing import AsyncIterator
+from fastapi import HTTPException
+from fastapi.responses import StreamingResponse
+from services.request_scope import run_cancellable
+
+logger = logging.getLogger(__name__)
+
+def format_sse(event: str, payload: dict) -> str:
+    return f"event: {event}\ndata: {json.dumps(payload, ensure_ascii=False)}\n\n"
+
+async def iter_text(text: str) -> AsyncIterator[str]:
+    """キャッシュ済みの応答などを1トークンとして流す。"""
+    yield text
+
+async def sse_response(tokens: AsyncIterator[str]) -> StreamingResponse:
+    """トークンのasync generatorをServer-Sent Eventsのレスポンスに変換する。
+
+    最初のトークンはレスポンスを返す前に取得するため、LLMサーバーへの接続エラーなどは
+    通常のHTTPエラーとしてクライアントに返る。最初のトークンを待つ間に期限切れや切断を検知した場合は生成を中断する。
+    """
+    iterator = tokens.__aiter__()
+    try:
+        first_token = await run_cancellable(iterator.__anext__())
+    except StopAsyncIteration:
+        first_token = None
+
+    async def event_stream():
+        chunks = []
+        try:
+            if first_token is not None:
+                chunks.append(first_token)
+                yield format_sse("token", {"token": first_token})
+                async for token in iterator:
+                    chunks.append(token)
+                    yield format_sse("token", {"token": token})
+            yield format_sse("done", {"reply": "".join(chunks).strip()})
+        except HTTPException as e:
+            logger.error("Error during LLM streaming: %s", e.detail)
+            yield format_sse("error", {"status_code": e.status_code, "detail": e.detail})
+        except Exception as e:
+            logger.exception("Error during LLM streaming: %s", e)
+            yield format_sse("error", {"status_code": 500, "detail": str(e)})
+
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
@@ -0,0 +1,131 @@
+import os
+import time
+import asyncio
+import logging
+from string import Formatter
+from typing import Awaitable, Callable
+import httpx
+from services.backend_pool import Backend, backend_pool
+from services.llm_service import get_llm_client
+from services.metrics import llm_ready, llm_startup_seconds
+
+logger = logging.getLogger(__name__)
+
+# 起動時の準備 (llama-serverの応答待ちとプロンプトキャッシュの温め) の設定
+# 準備が終わるまで GET /ready は503を返すので、ローリングデプロイでは温まったインスタンスにだけ振り分けられる
+LLM_WARMUP_ENABLED = os.getenv("LLM_WARMUP_ENABLED", "true").lower() in ("1", "true", "yes")
+LLM_READY_POLL_INTERVAL = float(os.getenv("LLM_READY_POLL_INTERVAL", "2.0")) # 秒。llama-serverのモデルロード中に死活確認する間隔
+LLM_WARMUP_TIMEOUT = float(os.getenv("LLM_WARMUP_TIMEOUT", "120")) # 秒。1プロンプトの評価を待つ上限
+
+def static_prefix(template: str) -> str:
+    """str.format用テンプレートの最初の置換フィールドより前の部分 (リクエストによらず同じ部分) を返す。"""
+    prefix = []
+    for literal, field, _, _ in Formatter().parse(template):
+        prefix.append(literal)
+        if field is not None:
+            break
+    return "".join(prefix)
+
+class Startup:
+    def __init__(self):
+        self.started_at = time.perf_counter()
+        self.phase = "starting"
+        self.timings: dict[str, float] = {} # フェーズ名 -> 秒
+        self._prompts: dict[str, str] = {}
+        self._tasks: dict[str, Callable[[], Awaitable]] = {}
+        self._task: asyncio.Task | None = None
+        llm_ready.set(value=0)
+
+    @property
+    def ready(self) -> bool:
+        return self.phase == "ready"
+
+    def register_prompt(self, name: str, template: str):
+        """静的なプレフィックスを起動時にllama-serverで評価しておくプロンプトを登録する。"""
+        self._prompts[name] = static_prefix(template)
+
+    def register_task(self, name: str, task: Callable[[], Awaitable]):
+        """遅延importしている重い初期化など、準備完了までに済ませておく処理を登録する。"""
+        self._tasks[name] = task
+
+    def _record(self, phase: str, seconds: float):
+        self.timings[phase] = seconds
+        llm_startup_seconds.set(phase, value=seconds)
+
+    def record_import(self, started_at: float):
+        # main.pyのimport開始時刻を起動時刻とする
+        self.started_at = started_at
+        self._record("import", time.perf_counter() - started_at)
+
+    def start(self):
+        self._task = asyncio.create_task(self._prepare())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def _prepare(self):
+        client = get_llm_client()
+        self.phase = "waiting_for_llm"
+        started = time.perf_counter()
+        backends = await self._wait_for_backends(client)
+        self._record("wait_for_llm", time.perf_counter() - started)
+
+        if LLM_WARMUP_ENABLED:
+            self.phase = "warming_up"
+            started = time.perf_counter()
+            await asyncio.gather(
+                *(self._warm_backend(client, backend) for backend in backends),
+                *(self._run_task(name, task) for name, task in self._tasks.items()),
+            )
+            self._record("warmup", time.perf_counter() - started)
+
+        self.phase = "ready"
+        llm_ready.set(value=1)
+        self._record("ready", time.perf_counter() - self.started_at)
+        logger.info("Service ready: %s", ", ".join(f"{phase}={seconds:.2f}s" for phase, seconds in self.timings.items()))
+
+    async def _wait_for_backends(self, client: httpx.AsyncClient) -> list[Backend]:
+        """少なくとも1台のllama-serverがヘルスチェックに通るまで待ち、通ったバックエンドを返す。"""
+        while True:
+            await backend_pool.check_health(client)
+            backends = [backend for backend in backend_pool.backends if backend.healthy]
+            if backends:
+                return backends
+            logger.info("Waiting for an LLM backend to become healthy...")
+            await asyncio.sleep(LLM_READY_POLL_INTERVAL)
+
+    async def _warm_backend(self, client: httpx.AsyncClient, backend: Backend):
+        # プロンプトごとに順に評価し、llama-serverのプロンプトキャッシュに載せる。
+        # llama_cpp.serverは `--cache true` で起動した場合だけ複数の接頭辞を保持する (なければ最後の1つしか残らない)。
+        # 生成は1トークンだけ (llama-cpp-pythonではmax_tokens=0がコンテキスト上限までの生成を意味するため)
+        for name, prefix in self._prompts.items():
+            started = time.perf_counter()
+            try:
+                response = await client.post(
+                    backend.endpoint("/v1/completions"),
+                    json={"prompt": prefix, "max_tokens": 1, "temperature": 0.0, "cache_prompt": True},
+                    timeout=LLM_WARMUP_TIMEOUT,
+                )
+                response.raise_for_status()
+            except httpx.HTTPError as e:
+                # 温めは最適化なので、失敗しても起動は続ける
+                logger.warning("Warm-up of prompt %s on %s failed: %s", name, backend.url, e)
+                continue
+            logger.info("Warmed prompt %s on %s in %.2fs", name, backend.url, time.perf_counter() - started)
+
+    async def _run_task(self, name: str, task: Callable[[], Awaitable]):
+        started = time.perf_counter()
+        try:
+            await task()
+        except Exception as e:
+            logger.warning("Warm-up task %s failed: %s", name, e)
+            return
+        logger.info("Warm-up task %s finished in %.2fs", name, time.perf_counter() - started)
+
+    def status(self) -> dict:
+        return {"status": self.phase, "timings": {phase: round(seconds, 3) for phase, seconds in self.timings.items()}}
+
+startup = Startup()
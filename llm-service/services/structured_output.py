@@ -0,0 +1,25 @@
+from pydantic import BaseModel
+
+# JSON文字列のGBNF定義 (制御文字を除く任意の文字とエスケープ)
+_GBNF_STRING = r'''string ::= "\"" ( [^"\\\x7F\x00-\x1F] | "\\" ( ["\\/bfnrt] | "u" [0-9a-fA-F] [0-9a-fA-F] [0-9a-fA-F] [0-9a-fA-F] ) )* "\""'''
+# 空白はllama.cppのjson.gbnfと同じく高々1つの空白か改行+インデントまで (無制限だと空白を延々と生成し続けることがある)
+_GBNF_WS = r'''ws ::= | " " | "\n" [ \t]{0,20}'''
+
+def json_object_grammar(model: type[BaseModel]) -> str:
+    """文字列フィールドだけを持つPydanticモデルから、llama.cppのGBNF文法を生成する。
+
+    キーはモデルの定義順で固定されるため、出力は必ず `json.loads` でき、閉じ括弧の直後で生成が止まる。
+    """
+    members = ' "," ws '.join(f'"\\"{name}\\"" ws ":" ws string ws' for name in model.model_fields)
+    return "\n".join([
+        f'root ::= "{{" ws {members} "}}"',
+        _GBNF_STRING,
+        _GBNF_WS,
+    ])
+
+def json_schema(model: type[BaseModel]) -> dict:
+    # llama.cppのjson_schemaパラメータ用。全フィールドを必須にして出力の形を固定する
+    schema = model.model_json_schema()
+    schema["required"] = list(model.model_fields)
+    schema["additionalProperties"] = False
+    return schema
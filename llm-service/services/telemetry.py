@@ -0,0 +1,99 @@
+import os
+import sys
+import queue
+import hashlib
+import logging
+from logging.handlers import QueueHandler, QueueListener
+from opentelemetry.sdk.trace.sampling import ParentBased, Sampler, SamplingResult, TraceIdRatioBased
+
+# トレースのコスト制御の設定
+TRACE_ATTRIBUTE_MAX_CHARS = int(os.getenv("TRACE_ATTRIBUTE_MAX_CHARS", "2048")) # 0以下で無制限
+TRACE_PROMPT_MODE = os.getenv("TRACE_PROMPT_MODE", "full") # full: 本文(上限付き) / hash: SHA-256のみ / off: 記録しない
+TRACE_SAMPLE_RATIO = float(os.getenv("TRACE_SAMPLE_RATIO", "1.0"))
+TRACE_SAMPLE_RATIOS = os.getenv("TRACE_SAMPLE_RATIOS", "") # ルートごとの上書き 例: "/classify-feedback/batch=0.01,/chat=0.5"
+LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", "10000"))
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO")
+
+def truncate_text(value: str, max_chars: int = TRACE_ATTRIBUTE_MAX_CHARS) -> str:
+    if max_chars <= 0 or len(value) <= max_chars:
+        return value
+    return f"{value[:max_chars]}...[truncated {len(value) - max_chars} chars]"
+
+def hash_text(value: str) -> str:
+    return "sha256:" + hashlib.sha256(value.encode("utf-8")).hexdigest()
+
+def set_text_attribute(span, key: str, value: str):
+    """上限付きで文字列属性を記録する。サンプリングされていないスパンでは何もしない。"""
+    if not span.is_recording():
+        return
+    span.set_attribute(key, truncate_text(value))
+
+def set_prompt_attribute(span, key: str, prompt: str):
+    # プロンプト本文は数KBになるため、TRACE_PROMPT_MODEに応じてハッシュだけを残せるようにする
+    if not span.is_recording() or TRACE_PROMPT_MODE == "off":
+        return
+    span.set_attribute(f"{key}.length", len(prompt))
+    if TRACE_PROMPT_MODE == "hash":
+        span.set_attribute(key, hash_text(prompt))
+    else:
+        span.set_attribute(key, truncate_text(prompt))
+
+def _parse_route_ratios(value: str) -> dict[str, float]:
+    ratios = {}
+    for item in value.split(","):
+        if "=" in item:
+            route, ratio = item.rsplit("=", 1)
+            ratios[route.strip()] = float(ratio)
+    return ratios
+
+class RouteRatioSampler(Sampler):
+    """ルート (URLパス) ごとの比率でルートスパンをサンプリングする。子スパンはParentBasedで親に従う。"""
+
+    def __init__(self, default_ratio: float, route_ratios: dict[str, float]):
+        self._default = TraceIdRatioBased(default_ratio)
+        self._routes = {route: TraceIdRatioBased(ratio) for route, ratio in route_ratios.items()}
+
+    def should_sample(self, parent_context, trace_id, name, kind=None, attributes=None, links=None, trace_state=None) -> SamplingResult:
+        attributes = attributes or {}
+        path = attributes.get("url.path") or attributes.get("http.target") or name.rsplit(" ", 1)[-1]
+        sampler = self._routes.get(str(path).split("?", 1)[0], self._default)
+        return sampler.should_sample(parent_context, trace_id, name, kind, attributes, links, trace_state)
+
+    def get_description(self) -> str:
+        routes = {route: sampler.rate for route, sampler in self._routes.items()}
+        return f"RouteRatioSampler{{default={self._default.rate}, routes={routes}}}"
+
+def create_sampler() -> Sampler:
+    return ParentBased(RouteRatioSampler(TRACE_SAMPLE_RATIO, _parse_route_ratios(TRACE_SAMPLE_RATIOS)))
+
+class _DroppingQueueHandler(QueueHandler):
+    """キューが満杯のときは待たずにログを捨てる (イベントループをブロックしない)。"""
+
+    dropped = 0
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            _DroppingQueueHandler.dropped += 1
+
+def setup_logging(*handlers: logging.Handler) -> QueueListener:
+    """stdoutへの出力はキュー経由で別スレッドのリスナーに任せ、handlers (OTLP) はルートロガーに直接付ける。
+
+    OTelのLoggingHandlerはemitしたスレッドの現在のスパンからtrace_id/span_idを取るため、リスナーのスレッドで
+    動かすとトレースとの紐付けが失われる。エクスポート自体はBatchLogRecordProcessorが別スレッドで行う。
+    """
+    stream_handler = logging.StreamHandler(sys.stdout)
+    stream_handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(name)s: %(message)s"))
+    log_queue: queue.Queue = queue.Queue(maxsize=LOG_QUEUE_SIZE)
+    listener = QueueListener(log_queue, stream_handler, respect_handler_level=True)
+
+    root = logging.getLogger()
+    root.setLevel(LOG_LEVEL)
+    # httpxはリクエストごとにINFOログを出すため抑制する
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+    root.addHandler(_DroppingQueueHandler(log_queue))
+    for handler in handlers:
+        root.addHandler(handler)
+    listener.start()
+    return listener